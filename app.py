@@ -1,13 +1,25 @@
+import os
+import threading
+import uuid
 import dash
+import flask
 import dash_core_components as dcc
 import dash_html_components as html
-from dash.dependencies import Output, Input, State
-import pandas as pd
+from dash.dependencies import Output, Input, State, ClientsideFunction
+from dash.exceptions import PreventUpdate
 from datetime import datetime as dt
-from datetime import timedelta
-from influxdb import DataFrameClient
-import numpy as np
+import figure_cache
 import generate_graph
+import metadata_cache
+import metadata_index
+import metrics
+import precompute
+import query_cache
+import render_pool
+import request_limiter
+import rollup
+import sankey_layout
+import sankey_transport
 import utilities
 
 
@@ -15,36 +27,83 @@ app = dash.Dash(__name__)
 app.title = "BDRG Sankey Generator"
 server = app.server
 
-# Reading metadata to memory
-sensor_metadata = pd.read_csv("./metadata/sensorMetadata.csv")
-building_metadata = pd.read_csv("./metadata/BuildingMetadataAll.csv")
-
-# Database connection
-influx_client = DataFrameClient(host='206.12.88.106', port=8086,
-                                username='root', password='root',
-                                database='sankey-generator')
+# Reading metadata to memory, from its compiled copy in SANKEY_METADATA_CACHE_DIR when set
+metadata_cache_dir = os.environ.get('SANKEY_METADATA_CACHE_DIR')
+sensor_metadata = metadata_cache.read_metadata("./metadata/sensorMetadata.csv",
+                                               metadata_cache_dir)
+building_metadata = metadata_cache.read_metadata("./metadata/BuildingMetadataAll.csv",
+                                                 metadata_cache_dir)
+
+# Building groupings offered in the campus view
+grouping_options = [{'label': 'Building use', 'value': 'building_type_mod'},
+                    {'label': 'Year of construction', 'value': 'year_built_grouping'},
+                    {'label': 'Floor area (m^2)', 'value': 'area_grouping'}]
+
+# Lookups used by every callback, built once at startup
+metadata = metadata_index.MetadataIndex(sensor_metadata, building_metadata,
+                                        [option['value'] for option in grouping_options])
+
+# Database connection pool, or the offline Arrow export of it when SANKEY_PARQUET_DIR is set.
+# Created by the first query, so that workers take traffic before importing the clients.
+influx_client = None
+influx_client_lock = threading.Lock()
+
+
+def get_influx_client():
+    global influx_client
+    with influx_client_lock:
+        if influx_client is None:
+            if os.environ.get('SANKEY_PARQUET_DIR'):
+                import parquet_source
+                influx_client = parquet_source.ParquetSource(os.environ['SANKEY_PARQUET_DIR'])
+            else:
+                import influx_pool
+                influx_client = influx_pool.ManagedInfluxClient(host='206.12.88.106',
+                                                                port=8086, username='root',
+                                                                password='root',
+                                                                database='sankey-generator')
+    return influx_client
+
+
+# Query result cache, shared on disk between gunicorn workers when SANKEY_CACHE_DIR is set
+if os.environ.get('SANKEY_CACHE_DIR'):
+    cache_backend = query_cache.DiskBackend(os.environ['SANKEY_CACHE_DIR'])
+else:
+    cache_backend = query_cache.MemoryBackend(max_entries=256)
+influx_query_cache = query_cache.QueryCache(cache_backend, ttl=300)
+
+# Daily rollup store kept up to date by `python rollup.py <directory>`
+if os.environ.get('SANKEY_ROLLUP_DIR'):
+    rollup_store = rollup.RollupStore(os.environ['SANKEY_ROLLUP_DIR'])
+else:
+    rollup_store = None
+
+# Finished figures, shared by every session of this worker
+sankey_figure_cache = figure_cache.FigureCache(max_entries=128, ttl=300)
+
+# Node orders of the diagrams by node set, so that nodes keep their place when only the dates
+# or the values change (the render pool processes keep their own)
+sankey_layout_cache = sankey_layout.LayoutCache(max_entries=256)
+
+# Send typed arrays and build the figure in the browser (assets/sankey_transport.js),
+# set SANKEY_LEAN_TRANSPORT=0 to send the full Plotly figure instead
+lean_transport = os.environ.get('SANKEY_LEAN_TRANSPORT', '1') != '0'
+# Links last sent to the browsers, so that a filter change only sends the link changes
+link_history = sankey_transport.LinkHistory(max_entries=256)
+
+# Main callback requests of each browser session: a newer one supersedes the older ones, at
+# most SANKEY_MAX_IN_FLIGHT run at once, and the changes of the multi-selects and date pickers
+# wait SANKEY_DEBOUNCE_MS for the next change first (see request_limiter.py)
+sankey_request_limiter = request_limiter.RequestLimiter(
+    max_in_flight=int(os.environ.get('SANKEY_MAX_IN_FLIGHT', 1)),
+    debounce=int(os.environ.get('SANKEY_DEBOUNCE_MS', 0)) / 1000)
+debounced_inputs = {'group-selection.value', 'building-filter.value',
+                    'category-selection.value', 'building-selection.value',
+                    'date-picker.start_date', 'date-picker.end_date',
+                    'date-picker-comparison.start_date', 'date-picker-comparison.end_date'}
 
 # Color and metric dictionnaries
-color_dict = {'node': {1: 'rgba(0, 172, 0, 1.0)',
-                       2: 'rgba(224, 0, 188, 1.0)',
-                       'real': 'rgba(100, 100, 100, 1.0)',
-                       'simulation': 'rgba(100, 100, 100, 0.5)',
-                       'building': 'rgba(177, 177, 177, 1.0)',
-                       'category': 'rgba(85, 85, 85, 1.0)',
-                       'group': 'rgba(85, 85, 85, 1.0)',
-                       'Elec': 'rgba(205, 52, 181, 1.0)',
-                       'HotWater': 'rgba(255, 177, 78, 1.0)',
-                       'Gas': 'rgba(0, 0, 255, 1.0)',
-                       },
-              'link': {'Elec': 'rgba(205, 52, 181, 0.2)',
-                       'HotWater': 'rgba(255, 177, 78, 0.2)',
-                       'Gas': 'rgba(0, 0, 255, 0.2)',
-                       1: {'real': 'rgba(177, 177, 177, 0.4)',
-                           'simulation': 'rgba(0, 172, 0, 0.1)'},
-                       2: {'real': 'rgba(224, 0, 188, 0.4)',
-                           'simulation': 'rgba(224, 0, 188, 0.1)'},
-                       'green': 'rgba(0, 172, 0, 0.4)',
-                       'red': 'rgba(224, 0, 30, 0.4)'}}
+color_dict = generate_graph.COLOR_DICT
 
 max_nodes = 20
 
@@ -56,8 +115,7 @@ max_date = dt(2020, 12, 1)
 initial_date = dt(2020, 9, 30)
 
 # Generating categories from the metadata
-category_columns = sensor_metadata.filter(regex='category', axis=1).columns
-category_options = utilities.generate_category_options(category_columns)
+category_options = utilities.generate_category_options(metadata.category_columns)
 
 # Generating metric list
 metric_dict = {"ref": ['Elec', 'Gas', 'HotWater'],
@@ -65,8 +123,13 @@ metric_dict = {"ref": ['Elec', 'Gas', 'HotWater'],
 
 metric_list = metric_dict['ref']
 
+# Intervals of the time-resolved campus view
+interval_options = [{'label': 'Daily', 'value': 'day'},
+                    {'label': 'Weekly', 'value': 'week'},
+                    {'label': 'Monthly', 'value': 'month'}]
+
 
-app.layout = html.Div([
+main_layout = html.Div([
     html.H2(children='EnergyFlowVis'),
     html.H5(children='Visualizing energy use flows',
             style={'font-style': 'italic', 'fontSize': '12'}),
@@ -78,10 +141,7 @@ app.layout = html.Div([
                    href='https://github.com/eta-lab/sankey-generator',
                    target="_blank"),
             dcc.Dropdown(id='building-grouping-selection',
-                         options=[
-                             {'label': 'Building use', 'value': 'building_type_mod'},
-                             {'label': 'Year of construction', 'value': 'year_built_grouping'},
-                             {'label': 'Floor area (m^2)', 'value': 'area_grouping'}],
+                         options=grouping_options,
                          searchable=False,
                          placeholder='Select building grouping',
                          value='building_type_mod',
@@ -161,12 +221,25 @@ app.layout = html.Div([
                 style={'display': 'block'}
             ),
 
+            html.P(children='Animate the campus flows over the first period',
+                   style={'margin-top': '10px'})
+            ,
+            dcc.Dropdown(id='interval-selection',
+                         options=interval_options,
+                         searchable=False,
+                         placeholder='Whole period',
+                         style={'margin-bottom': '10px'})
+            ,
+
         ], style={'height': '700'})
     ], style={'width': '20%', 'display': 'inline-block', 'vertical-align': 'top'}
     ),
     html.Div([
         html.Div([
-            dcc.Graph(id='sankey-diagram')
+            dcc.Graph(id='sankey-diagram'),
+            dcc.Store(id='sankey-payload'),
+            dcc.Store(id='sankey-client-state'),
+            dcc.Store(id='sankey-resend')
         ], className='row', style={'height': '100%'})
     ], id='graph-container',
         style={'width': '78%',
@@ -177,20 +250,20 @@ app.layout = html.Div([
 ])
 
 
+def serve_layout():
+    # Every page load is a session of its own for the request limiter
+    return html.Div([main_layout, dcc.Store(id='session-id', data=uuid.uuid4().hex)])
+
+
+app.layout = serve_layout
+
+
 @app.callback(
     Output(component_id='category-selection', component_property='options'),
     [Input(component_id='category-type-selection', component_property='value')]
 )
 def generate_cluster_list_campus(category_type):
-    category_list = sensor_metadata[category_type].unique()
-
-    if len(category_list) > 0:
-        options = utilities.generate_option_array_from_list(np.sort(category_list))
-
-    else:
-        options = [{'label': 'Not Found', 'value': 'nan'}]
-
-    return options
+    return metadata.category_options(category_type)
 
 
 @app.callback(
@@ -199,14 +272,7 @@ def generate_cluster_list_campus(category_type):
      Input(component_id='category-selection', component_property='value')]
 )
 def generate_cluster_list_campus(category_type, category_selection):
-    if category_selection:
-        building_list = sensor_metadata.loc[
-            sensor_metadata[category_type].isin(category_selection), 'building'].unique()
-    else:
-        building_list = sensor_metadata['building'].unique()
-    options = utilities.generate_option_array_from_list(np.sort(building_list))
-
-    return options
+    return metadata.building_options(category_type, category_selection)
 
 
 # enable of disable the date compare
@@ -222,10 +288,8 @@ def generate_cluster_list_campus(category_type, category_selection):
 def enable_date_comparison(on_off, start_date, end_date):
     if on_off:
         disabled_date = False
-        start_date_compare = dt.strftime(dt.strptime(start_date, "%Y-%m-%d") -
-                                         timedelta(days=30), "%Y-%m-%d")
-        end_date_compare = dt.strftime(dt.strptime(end_date, "%Y-%m-%d") -
-                                       timedelta(days=30), "%Y-%m-%d")
+        start_date_compare, end_date_compare = utilities.generate_comparison_dates(start_date,
+                                                                                   end_date)
         date_style = {'margin-bottom': '30px', 'border': '2px black solid'}
     else:
         disabled_date = True
@@ -240,9 +304,7 @@ def enable_date_comparison(on_off, start_date, end_date):
 @app.callback(Output(component_id='group-selection', component_property='options'),
               [Input(component_id='building-grouping-selection', component_property='value')])
 def building_group_list(building_grouping):
-    group_list = building_metadata[building_grouping].unique()
-    options = utilities.generate_option_array_from_list(group_list)
-    return options
+    return metadata.group_options(building_grouping)
 
 
 # Generate the list of buildings from the group filtered
@@ -250,14 +312,7 @@ def building_group_list(building_grouping):
               [Input(component_id='building-grouping-selection', component_property='value'),
                Input(component_id='group-selection', component_property='value')])
 def building_filter_list(building_grouping, group_selection):
-    if group_selection:
-        building_list = building_metadata[
-            building_metadata[building_grouping].isin(group_selection)].building
-    else:
-        building_list = building_metadata.building
-
-    options = utilities.generate_option_array_from_list(building_list)
-    return options
+    return metadata.building_filter_options(building_grouping, group_selection)
 
 
 # Lock second date when building is selected
@@ -276,7 +331,16 @@ def turn_off_date_compare(building_selection):
 
 
 # Generate Campus Sankey Figure
-@app.callback(Output(component_id='sankey-diagram', component_property='figure'),
+if lean_transport:
+    sankey_output = Output(component_id='sankey-payload', component_property='data')
+    sankey_states = [State(component_id='session-id', component_property='data'),
+                     State(component_id='sankey-client-state', component_property='data')]
+else:
+    sankey_output = Output(component_id='sankey-diagram', component_property='figure')
+    sankey_states = [State(component_id='session-id', component_property='data')]
+
+
+@app.callback(sankey_output,
               [Input(component_id='building-grouping-selection', component_property='value'),
                Input(component_id='group-selection', component_property='value'),
                Input(component_id='building-filter', component_property='value'),
@@ -286,55 +350,310 @@ def turn_off_date_compare(building_selection):
                Input(component_id='date-picker', component_property='start_date'),
                Input(component_id='date-picker', component_property='end_date'),
                Input(component_id='date-picker-comparison', component_property='start_date'),
-               Input(component_id='date-picker-comparison', component_property='end_date')])
+               Input(component_id='date-picker-comparison', component_property='end_date'),
+               Input(component_id='interval-selection', component_property='value'),
+               Input(component_id='sankey-resend', component_property='data')],
+              sankey_states)
 def display_and_update_building_sankey_diagram(grouping_type, group_selection, building_filter,
-                                               category_type, category_selection, building_selection,
-                                               start_date_1, end_date_1,
-                                               start_date_2, end_date_2):
-    if building_selection:
-        if category_selection:
-            metadata = sensor_metadata[sensor_metadata[category_type].isin(category_selection)]
-        else:
-            metadata = sensor_metadata
+                                               category_type, category_selection,
+                                               building_selection, start_date_1, end_date_1,
+                                               start_date_2, end_date_2, interval=None,
+                                               resend=None, session_id=None, client_state=None):
+    date_periods = [(start_date_1, end_date_1), (start_date_2, end_date_2)]
 
-        metadata = metadata[metadata['building'].isin(building_selection)]
-        building_list = metadata['building'].unique()
+    if building_selection:
+        view = 'simulation'
+    else:
+        view = 'frames' if interval else 'campus'
+    inputs = {'grouping_type': grouping_type, 'group_selection': group_selection,
+              'building_filter': building_filter, 'category_type': category_type,
+              'category_selection': category_selection,
+              'building_selection': building_selection, 'date_periods': date_periods,
+              'interval': interval}
+    triggered = {trigger['prop_id'] for trigger in dash.callback_context.triggered}
+    debounce = None if triggered & debounced_inputs else 0
+    # The browser asks for everything again when it no longer has the nodes or links the last
+    # update was built on
+    if 'sankey-resend.data' in triggered:
+        client_state = None
+    try:
+        with sankey_request_limiter.request(session_id, debounce):
+            with metrics.request_span(view, inputs):
+                cached_output = get_sankey_output(grouping_type, group_selection,
+                                                  building_filter, category_type,
+                                                  category_selection, building_selection,
+                                                  date_periods, interval)
+                sankey_request_limiter.check()
+
+                if lean_transport:
+                    with metrics.span('figure_delta'):
+                        return sankey_transport.generate_sankey_update(cached_output,
+                                                                       client_state,
+                                                                       link_history)
+            return cached_output
+    except request_limiter.Superseded:
+        # The browser keeps the figure until the answer to the newer request
+        raise PreventUpdate
+
+
+if lean_transport:
+    app.clientside_callback(
+        ClientsideFunction(namespace='sankey', function_name='render'),
+        [Output(component_id='sankey-diagram', component_property='figure'),
+         Output(component_id='sankey-client-state', component_property='data'),
+         Output(component_id='sankey-resend', component_property='data')],
+        [Input(component_id='sankey-payload', component_property='data')])
+
+
+def get_sankey_output(grouping_type, group_selection, building_filter,
+                      category_type, category_selection, building_selection, date_periods,
+                      interval=None):
+    # Only the inputs used by the selected view take part in the figure key
+    if building_selection:
+        figure_key = figure_cache.generate_figure_key(
+            'building', category_type,
+            figure_cache.normalize_selection(category_selection),
+            figure_cache.normalize_selection(building_selection),
+            figure_cache.generate_date_periods_key(date_periods))
+    elif interval:
+        # The time-resolved view only animates the first period
+        date_periods = date_periods[:1]
+        figure_key = figure_cache.generate_figure_key(
+            'frames', grouping_type,
+            figure_cache.normalize_selection(group_selection),
+            figure_cache.normalize_selection(building_filter),
+            figure_cache.generate_date_periods_key(date_periods), interval)
+    else:
+        figure_key = figure_cache.generate_figure_key(
+            'campus', grouping_type,
+            figure_cache.normalize_selection(group_selection),
+            figure_cache.normalize_selection(building_filter),
+            figure_cache.generate_date_periods_key(date_periods))
+    closed = all(query_cache.is_closed_range(end_date) for _, end_date in date_periods)
+
+    return sankey_figure_cache.get_or_compute(
+        figure_key,
+        lambda: generate_sankey_output(grouping_type, group_selection, building_filter,
+                                       category_type, category_selection,
+                                       building_selection, date_periods, interval),
+        closed)
+
+
+def generate_sankey_output(grouping_type, group_selection, building_filter,
+                           category_type, category_selection, building_selection,
+                           date_periods, interval=None):
+    if building_selection:
+        sensor_metadata_filtered = metadata.filter_sensor_metadata(category_type,
+                                                                   category_selection,
+                                                                   building_selection)
+        building_list = sensor_metadata_filtered['building'].unique()
         building_list_sim = utilities.generate_building_list_sim(building_list)
 
-        query_result_dates = generate_graph.generate_dates_query(influx_client,
+        query_result_dates = generate_graph.generate_dates_query(get_influx_client(),
                                                                  building_list_sim,
-                                                                 start_date_1, end_date_1,
-                                                                 start_date_2, end_date_2)
+                                                                 date_periods,
+                                                                 influx_query_cache,
+                                                                 rollup_store,
+                                                                 sensor_metadata_filtered
+                                                                 .sensor_short_id.unique())
+        sankey_request_limiter.check()
 
-        element_dict = generate_graph.generate_sankey_elements_simulation(query_result_dates,
-                                                                        metadata,
-                                                                        category_type,
-                                                                        color_dict)
+        element_dict = generate_graph.generate_sankey_elements_simulation(
+            query_result_dates, sensor_metadata_filtered, category_type, color_dict,
+            layout_cache=sankey_layout_cache)
 
     else:
-        if group_selection:
-            building_metadata_filtered = building_metadata[
-                building_metadata[grouping_type].isin(group_selection)]
-        else:
-            building_metadata_filtered = building_metadata
-
-        if building_filter:
-            building_metadata_filtered = building_metadata_filtered[
-                building_metadata_filtered.building.isin(building_filter)]
+        building_metadata_filtered = metadata.filter_building_metadata(grouping_type,
+                                                                       group_selection,
+                                                                       building_filter)
 
-        query_result_dates = generate_graph.generate_dates_query(influx_client,
+        # Only the buildings left by the filters are read, every building otherwise
+        if group_selection or building_filter:
+            building_columns = building_metadata_filtered.building.unique()
+        else:
+            building_columns = None
+
+        if interval:
+            start_date, end_date = date_periods[0]
+            interval_labels, interval_values, columns = generate_graph.generate_interval_query(
+                get_influx_client(), start_date, end_date, metric_list, interval,
+                influx_query_cache, building_columns)
+            sankey_request_limiter.check()
+            return figure_render_pool.run(build_frames_output, interval_labels, interval_values,
+                                          columns, grouping_type, group_selection,
+                                          building_filter)
+
+        # With a rollup the top buildings are ranked before the query, which then only reads
+        # them, and the buildings of the 'Other' nodes are summed from the rollup and the
+        # influx edges of the same periods
+        building_list = building_metadata_filtered.building.unique()
+        top_n_building = None
+        other_result_dates = None
+        if rollup_store is not None and len(building_list) > max_nodes:
+            rollup_ranking = generate_graph.generate_top_n_from_rollup(get_influx_client(),
+                                                                       rollup_store, metric_list,
+                                                                       date_periods,
+                                                                       building_list, max_nodes)
+            if rollup_ranking is not None:
+                top_n_building, other_result_dates = rollup_ranking
+                building_columns = top_n_building
+
+        query_result_dates = generate_graph.generate_dates_query(get_influx_client(),
                                                                  metric_list,
-                                                                 start_date_1, end_date_1,
-                                                                 start_date_2, end_date_2)
-
-        element_dict = generate_graph.generate_sankey_elements_campus(query_result_dates, metric_list,
-                                                                      building_metadata_filtered,
-                                                                      grouping_type, max_nodes,
-                                                                      color_dict)
-
-    sankey_figure = generate_graph.generate_sankey_figure(element_dict)
-
-    return sankey_figure
+                                                                 date_periods,
+                                                                 influx_query_cache,
+                                                                 rollup_store,
+                                                                 building_columns)
+        if other_result_dates is not None:
+            query_result_dates = generate_graph.join_query_results(query_result_dates,
+                                                                   other_result_dates)
+
+        sankey_request_limiter.check()
+        return figure_render_pool.run(build_campus_output, query_result_dates, grouping_type,
+                                      group_selection, building_filter, top_n_building)
+
+    return generate_figure_output(element_dict)
+
+
+# Campus renders, run in the render pool when it is enabled. They filter the metadata again
+# from the copy shared with the pool workers rather than receiving it.
+def build_campus_output(query_result_dates, grouping_type, group_selection, building_filter,
+                        top_n_building):
+    building_metadata_filtered = metadata.filter_building_metadata(grouping_type,
+                                                                   group_selection,
+                                                                   building_filter)
+    element_dict = generate_graph.generate_sankey_elements_campus(query_result_dates, metric_list,
+                                                                  building_metadata_filtered,
+                                                                  grouping_type, max_nodes,
+                                                                  color_dict, top_n_building,
+                                                                  sankey_layout_cache)
+    return generate_figure_output(element_dict)
+
+
+def build_frames_output(interval_labels, interval_values, columns, grouping_type,
+                        group_selection, building_filter):
+    building_metadata_filtered = metadata.filter_building_metadata(grouping_type,
+                                                                   group_selection,
+                                                                   building_filter)
+    element_dict = generate_graph.generate_sankey_elements_frames(
+        interval_labels, interval_values, columns, metric_list, building_metadata_filtered,
+        grouping_type, max_nodes, color_dict, layout_cache=sankey_layout_cache)
+    return generate_figure_output(element_dict)
+
+
+def generate_figure_output(element_dict):
+    with metrics.span('figure_serialization'):
+        if lean_transport:
+            return sankey_transport.generate_sankey_payload(element_dict)
+
+        return generate_graph.generate_sankey_figure_dict(element_dict)
+
+
+def generate_precompute_jobs(n_months=precompute.N_MONTHS):
+    windows = [(default_start_date, default_end_date)] + \
+        precompute.generate_month_windows(max_date, n_months)
+    return precompute.generate_jobs([option['value'] for option in grouping_options],
+                                    precompute.generate_popular_date_periods(windows))
+
+
+def warm_sankey_output(grouping_type, date_periods):
+    # The unfiltered campus view, as it is shown after picking a grouping and dates
+    with metrics.request_span('precompute', {'grouping_type': grouping_type,
+                                             'date_periods': date_periods}):
+        get_sankey_output(grouping_type, None, None, 'category_end_use', None, None,
+                          date_periods)
+
+
+def get_local_layout_stats():
+    # Layout cache counters of this process, sent back by the render pool processes as well
+    return sankey_layout_cache.stats()
+
+
+def get_layout_stats():
+    # The layouts rendered in the pool are cached in its processes, their counters add up
+    layout_stats = get_local_layout_stats()
+    for worker_stats in figure_render_pool.collected_worker_stats().values():
+        for name in layout_stats:
+            layout_stats[name] += worker_stats[name]
+    return layout_stats
+
+
+# Campus element building and serialization in SANKEY_RENDER_WORKERS forked processes,
+# started before any thread of this process
+figure_render_pool = render_pool.RenderPool(int(os.environ.get('SANKEY_RENDER_WORKERS', 0)),
+                                            get_local_layout_stats)
+if figure_render_pool.max_workers > 0:
+    figure_render_pool.start()
+
+
+# Off-peak cache warm-up, see precompute.py for the settings. The scheduler starts in every
+# worker, with SANKEY_CACHE_DIR set only the one holding its lock file warms.
+if os.environ.get('SANKEY_PRECOMPUTE') == '1':
+    if os.environ.get('SANKEY_CACHE_DIR'):
+        precompute_lock_path = os.path.join(os.environ['SANKEY_CACHE_DIR'],
+                                            precompute.LOCK_NAME)
+    else:
+        precompute_lock_path = None
+    precompute_scheduler = precompute.PrecomputeScheduler(
+        warm_sankey_output,
+        generate_precompute_jobs(int(os.environ.get('SANKEY_PRECOMPUTE_MONTHS',
+                                                    precompute.N_MONTHS))),
+        max_workers=int(os.environ.get('SANKEY_PRECOMPUTE_WORKERS', precompute.MAX_WORKERS)),
+        off_peak_hours=precompute.parse_hours(
+            os.environ.get('SANKEY_PRECOMPUTE_HOURS',
+                           '{}-{}'.format(*precompute.OFF_PEAK_HOURS))),
+        lock_path=precompute_lock_path)
+    precompute_scheduler.start()
+
+
+# Cache counters, to watch the hit rate and stampedes absorbed by the figure cache
+@server.route('/cache-stats')
+def cache_stats():
+    return flask.jsonify({'figure': sankey_figure_cache.stats(),
+                          'query': {'hits': influx_query_cache.hits,
+                                    'misses': influx_query_cache.misses},
+                          'layout': get_layout_stats(),
+                          'requests': sankey_request_limiter.stats()})
+
+
+# Stage latency histograms and cache counters in the Prometheus text format
+@server.route('/metrics')
+def prometheus_metrics():
+    figure_stats = sankey_figure_cache.stats()
+    lines = metrics.render_histograms()
+    lines += metrics.render_counters(
+        'sankey_figure_cache_total', 'Figure cache lookups by result.',
+        {(('result', result),): figure_stats[result]
+         for result in ['hits', 'misses', 'coalesced']})
+    lines += metrics.render_counters(
+        'sankey_query_cache_total', 'Query cache lookups by result.',
+        {(('result', 'hits'),): influx_query_cache.hits,
+         (('result', 'misses'),): influx_query_cache.misses})
+    request_stats = sankey_request_limiter.stats()
+    lines += metrics.render_counters(
+        'sankey_requests_total', 'Main callback requests by result, the dropped ones were '
+        'superseded by a newer request of their session.',
+        {(('result', 'admitted'),): request_stats['admitted'],
+         (('result', 'dropped_waiting'),): request_stats['dropped_waiting'],
+         (('result', 'dropped_running'),): request_stats['dropped_running']})
+    pool_stats = figure_render_pool.stats()
+    lines += metrics.render_counters(
+        'sankey_render_pool_tasks', 'Renders sent to the render pool and not finished yet.',
+        {(('state', 'in_flight'),): pool_stats['in_flight'],
+         (('state', 'queued'),): pool_stats['queue_depth']}, 'gauge')
+    lines += metrics.render_counters(
+        'sankey_render_pool_workers', 'Processes of the render pool.',
+        {(): pool_stats['workers']}, 'gauge')
+    lines += metrics.render_counters(
+        'sankey_render_pool_busy_seconds_total',
+        'Time the render pool processes spent rendering, divide its rate by the workers '
+        'for the utilization.',
+        {(): pool_stats['busy_seconds']})
+    lines += metrics.render_counters(
+        'sankey_render_pool_renders_total', 'Renders run by the render pool by result.',
+        {(('result', 'completed'),): pool_stats['completed'],
+         (('result', 'broken_pool'),): pool_stats['failed']})
+    return flask.Response('\n'.join(lines) + '\n', mimetype='text/plain; version=0.0.4')
 
 
 if __name__ == '__main__':
@@ -0,0 +1,199 @@
+// Builds the Sankey figure from the lean payload of sankey_transport.py
+(function () {
+    var ARRAY_TYPES = {
+        int32: Int32Array,
+        float32: Float32Array,
+        uint8: Uint8Array,
+        uint16: Uint16Array
+    };
+    var MAX_CACHED_NODES = 8;
+    var MAX_CACHED_LINKS = 8;
+    var nodeCache = {};
+    var nodeCacheOrder = [];
+    var linkCache = {};
+    var linkCacheOrder = [];
+    var resendCount = 0;
+
+    function decodeArray(encoded) {
+        var binary = atob(encoded.data);
+        var bytes = new Uint8Array(binary.length);
+        for (var i = 0; i < binary.length; i++) {
+            bytes[i] = binary.charCodeAt(i);
+        }
+        return Array.from(new ARRAY_TYPES[encoded.dtype](bytes.buffer));
+    }
+
+    function decodeColors(palette, encoded) {
+        return decodeArray(encoded).map(function (index) {
+            return palette[index];
+        });
+    }
+
+    function decodeNodes(nodes) {
+        return {
+            pad: 15,
+            thickness: 20,
+            line: {color: 'black', width: 0.5},
+            label: nodes.labels,
+            color: decodeColors(nodes.palette, nodes.color)
+        };
+    }
+
+    // The positions come with every payload, the cached nodes are left as they were
+    function placeNodes(node, positions) {
+        if (positions === null) {
+            return node;
+        }
+        return Object.assign({}, node, {x: decodeArray(positions.x),
+                                        y: decodeArray(positions.y)});
+    }
+
+    function cacheEntry(cache, order, maxEntries, key, value) {
+        if (!(key in cache)) {
+            order.push(key);
+            if (order.length > maxEntries) {
+                delete cache[order.shift()];
+            }
+        }
+        cache[key] = value;
+    }
+
+    function decodeLinks(links) {
+        return {
+            source: decodeArray(links.source),
+            target: decodeArray(links.target),
+            value: decodeArray(links.value),
+            color: decodeColors(links.palette, links.color)
+        };
+    }
+
+    // Mirrors generate_links_delta: renumber the nodes, update values, drop removed links
+    // and append added ones
+    function applyDelta(base, delta) {
+        var source = base.source;
+        var target = base.target;
+        if (delta.node_map !== null) {
+            var nodeMap = decodeArray(delta.node_map);
+            source = source.map(function (index) { return nodeMap[index]; });
+            target = target.map(function (index) { return nodeMap[index]; });
+        }
+        var value = base.value.slice();
+        var updateIndex = decodeArray(delta.update_index);
+        var updateValue = decodeArray(delta.update_value);
+        for (var i = 0; i < updateIndex.length; i++) {
+            value[updateIndex[i]] = updateValue[i];
+        }
+
+        var removed = {};
+        decodeArray(delta.remove).forEach(function (index) {
+            removed[index] = true;
+        });
+        var links = {source: [], target: [], value: [], color: []};
+        for (var j = 0; j < value.length; j++) {
+            if (!removed[j]) {
+                links.source.push(source[j]);
+                links.target.push(target[j]);
+                links.value.push(value[j]);
+                links.color.push(base.color[j]);
+            }
+        }
+
+        var added = decodeLinks(delta.add);
+        ['source', 'target', 'value', 'color'].forEach(function (name) {
+            links[name] = links[name].concat(added[name]);
+        });
+        return links;
+    }
+
+    // Nodes or base links unknown here (evicted, page reloaded, another tab): forget the state
+    // and ask the server to send the whole figure again
+    function requestResend() {
+        resendCount += 1;
+        return [window.dash_clientside.no_update, null, resendCount];
+    }
+
+    function buildTrace(node, links) {
+        return {type: 'sankey', valuesuffix: ' kWh', node: node, link: links};
+    }
+
+    // Same slider and play button as generate_animation_layout
+    function buildAnimationLayout(layout, labels) {
+        var frameArgs = {mode: 'immediate', frame: {duration: 0, redraw: true},
+                         transition: {duration: 0}};
+        layout.margin.b = 120;
+        layout.sliders = [{
+            active: 0,
+            currentvalue: {prefix: ''},
+            pad: {t: 20},
+            steps: labels.map(function (label) {
+                return {label: label, method: 'animate', args: [[label], frameArgs]};
+            })
+        }];
+        layout.updatemenus = [{
+            type: 'buttons',
+            showactive: false,
+            x: 0, y: 0, xanchor: 'right', yanchor: 'top',
+            pad: {t: 20, r: 10},
+            buttons: [{label: 'Play', method: 'animate',
+                       args: [null, {fromcurrent: true,
+                                     frame: {duration: 700, redraw: true},
+                                     transition: {duration: 0}}]}]
+        }];
+    }
+
+    function buildFigure(node, links, frames) {
+        var figure = {
+            data: [buildTrace(node, links)],
+            layout: {margin: {l: 10, r: 100, b: 30, t: 0, pad: 0}}
+        };
+        if (frames) {
+            // One frame per interval, sharing the nodes and links but their values
+            var values = decodeArray(frames.value);
+            var nLinks = links.value.length;
+            figure.frames = frames.labels.map(function (label, f) {
+                var frameLinks = Object.assign({}, links, {
+                    value: values.slice(f * nLinks, (f + 1) * nLinks)
+                });
+                return {name: label, data: [buildTrace(node, frameLinks)]};
+            });
+            buildAnimationLayout(figure.layout, frames.labels);
+        }
+        return figure;
+    }
+
+    window.dash_clientside = Object.assign({}, window.dash_clientside, {
+        sankey: {
+            render: function (payload) {
+                var noUpdate = window.dash_clientside.no_update;
+                if (!payload) {
+                    return [noUpdate, null, noUpdate];
+                }
+
+                var node;
+                if (payload.nodes !== null) {
+                    node = decodeNodes(payload.nodes);
+                    cacheEntry(nodeCache, nodeCacheOrder, MAX_CACHED_NODES, payload.node_key,
+                               node);
+                } else if (payload.node_key in nodeCache) {
+                    node = nodeCache[payload.node_key];
+                } else {
+                    return requestResend();
+                }
+
+                var links;
+                if (payload.delta !== null) {
+                    if (!(payload.delta.base in linkCache)) {
+                        return requestResend();
+                    }
+                    links = applyDelta(linkCache[payload.delta.base], payload.delta);
+                } else {
+                    links = decodeLinks(payload.links);
+                }
+                cacheEntry(linkCache, linkCacheOrder, MAX_CACHED_LINKS, payload.links_key, links);
+
+                return [buildFigure(placeNodes(node, payload.positions), links, payload.frames),
+                        {node_key: payload.node_key, links_key: payload.links_key}, noUpdate];
+            }
+        }
+    });
+})();
@@ -0,0 +1,217 @@
+import argparse
+import importlib.util
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pandas as pd
+
+import generate_graph
+import metadata_cache
+import metadata_index
+import rollup
+import utilities
+
+
+# Headless export of the building Sankey diagrams, one per building, category type and period:
+#   python batch_export.py reports --months 2020-01 2020-10 --formats json html
+# or with a job spec file holding any of the same settings:
+#   {"buildings": [...], "category_types": [...], "months": ["2020-01", "2020-10"],
+#    "periods": [["2020-10-01", "2020-10-31"]], "view": "simulation", "formats": ["html"]}
+# Buildings and category types default to every building with sensors and every category_*
+# column. Each period is read once for all the diagrams, in groups of buildings whose sensors
+# fit in one query, and the diagrams of a group are built and written by a process pool while
+# the next group is read. Files are written to
+#   <output>/<start>_<end>/<category type>/<building>.<format>
+# through a temporary file, so an interrupted run is resumed by running it again: the
+# diagrams whose files all exist are skipped.
+VIEWS = {'simulation': generate_graph.generate_sankey_elements_simulation,
+         'building': generate_graph.generate_sankey_elements_building}
+TEXT_FORMATS = ['json', 'html']
+IMAGE_FORMATS = ['png', 'svg', 'pdf']
+
+logger = logging.getLogger(__name__)
+
+
+def generate_month_periods(start_month, end_month):
+    # Calendar months as the date pickers give them, first and last day
+    return [(month.start_time.strftime('%Y-%m-%d'), month.end_time.strftime('%Y-%m-%d'))
+            for month in pd.period_range(start_month, end_month, freq='M')]
+
+
+def load_job_spec(path):
+    with open(path) as spec_file:
+        job_spec = json.load(spec_file)
+    if 'months' in job_spec:
+        job_spec['periods'] = job_spec.get('periods', []) + \
+            generate_month_periods(*job_spec.pop('months'))
+    job_spec['periods'] = [tuple(period) for period in job_spec.get('periods', [])]
+    return job_spec
+
+
+def generate_jobs(metadata, buildings, category_types, periods):
+    # (period, category type, building) of every diagram, grouped by period
+    building_list = list(metadata.building_sensors) if buildings is None else buildings
+    category_list = metadata.category_columns if category_types is None else category_types
+    return [(period, category_type, building) for period in periods
+            for category_type in category_list for building in building_list]
+
+
+def generate_output_path(output_dir, job, output_format):
+    (start_date, end_date), category_type, building = job
+    return os.path.join(output_dir, '{}_{}'.format(start_date, end_date), category_type,
+                        '{}.{}'.format(building, output_format))
+
+
+def is_job_done(output_dir, job, formats):
+    return all(os.path.exists(generate_output_path(output_dir, job, output_format))
+               for output_format in formats)
+
+
+def write_output(path, figure, output_format):
+    # Plotly is only needed to write the files, each pool process imports it once
+    import plotly.io
+    import plotly.utils
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    temp_path = '{}.tmp-{}'.format(path, os.getpid())
+    if output_format == 'json':
+        with open(temp_path, 'w') as output_file:
+            json.dump(figure, output_file, cls=plotly.utils.PlotlyJSONEncoder)
+    elif output_format == 'html':
+        with open(temp_path, 'w') as output_file:
+            output_file.write(plotly.io.to_html(figure, include_plotlyjs='cdn',
+                                                validate=False))
+    else:
+        plotly.io.write_image(figure, temp_path, format=output_format, validate=False)
+    os.replace(temp_path, path)
+
+
+def render_job(job, query_result, sensor_metadata, view, formats, output_dir):
+    # Runs in the pool: query_result only holds the rows and columns of the building
+    date_range = generate_graph.generate_date_range_label(*job[0])
+    element_dict = VIEWS[view]({date_range: query_result}, sensor_metadata, job[1],
+                               generate_graph.COLOR_DICT)
+    figure = generate_graph.generate_sankey_figure_dict(element_dict)
+    for output_format in formats:
+        write_output(generate_output_path(output_dir, job, output_format), figure,
+                     output_format)
+    return job
+
+
+def run_batch(influx_client, metadata, jobs, view, formats, output_dir, max_workers=None,
+              rollup_store=None):
+    # Returns the number of diagrams written and failed
+    pending_jobs = [job for job in jobs if not is_job_done(output_dir, job, formats)]
+    logger.info('%d of %d diagrams to export', len(pending_jobs), len(jobs))
+
+    periods = list(dict.fromkeys(job[0] for job in pending_jobs))
+    written = 0
+    failed = 0
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        futures = []
+        for period in periods:
+            period_jobs = [job for job in pending_jobs if job[0] == period]
+            buildings = list(dict.fromkeys(job[2] for job in period_jobs))
+            # The diagrams of a group are rendered while the next group is read
+            for building_group in generate_graph.generate_building_groups(metadata,
+                                                                          buildings):
+                query_result = generate_graph.query_buildings(influx_client, metadata, period,
+                                                              building_group, rollup_store)
+                for job in period_jobs:
+                    _, category_type, building = job
+                    if building not in building_group:
+                        continue
+                    sensor_metadata = metadata.filter_sensor_metadata(category_type, None,
+                                                                      [building])
+                    # Sensors without any value are not in the result, as for the app
+                    building_result = query_result.loc[
+                        utilities.generate_building_list_sim([building]),
+                        query_result.columns.isin(sensor_metadata.sensor_short_id)]
+                    futures.append(executor.submit(render_job, job, building_result,
+                                                   sensor_metadata, view, formats, output_dir))
+
+        for future in as_completed(futures):
+            try:
+                (start_date, end_date), category_type, building = future.result()
+            except Exception:
+                logger.exception('Exporting a diagram failed')
+                failed += 1
+                continue
+            written += 1
+            logger.info('[%d/%d] %s %s %s to %s', written + failed, len(futures), building,
+                        category_type, start_date, end_date)
+
+    return written, failed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export the building Sankey diagrams of many '
+                                                 'buildings, category types and periods')
+    parser.add_argument('output_dir')
+    parser.add_argument('--spec', help='JSON job spec, the options below override it')
+    parser.add_argument('--buildings', nargs='+', help='defaults to every building')
+    parser.add_argument('--category-types', nargs='+',
+                        help='defaults to every category_* column')
+    parser.add_argument('--months', nargs=2, metavar=('START', 'END'),
+                        help='export every month from START to END (YYYY-MM)')
+    parser.add_argument('--view', choices=sorted(VIEWS))
+    parser.add_argument('--formats', nargs='+', choices=TEXT_FORMATS + IMAGE_FORMATS)
+    parser.add_argument('--workers', type=int, default=None,
+                        help='rendering processes, defaults to the number of CPUs')
+    parser.add_argument('--parquet-dir', help='read the offline Arrow export instead of InfluxDB')
+    parser.add_argument('--rollup-dir', help='daily rollup store kept by rollup.py')
+    parser.add_argument('--metadata-cache-dir', help='compiled metadata, see metadata_cache.py')
+    parser.add_argument('--host', default='206.12.88.106')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='sankey-generator')
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+
+    spec = load_job_spec(arguments.spec) if arguments.spec else {'periods': []}
+    if arguments.months:
+        spec['periods'] = generate_month_periods(*arguments.months)
+    for key in ['buildings', 'category_types', 'view', 'formats']:
+        if getattr(arguments, key) is not None:
+            spec[key] = getattr(arguments, key)
+    spec.setdefault('view', 'simulation')
+    spec.setdefault('formats', ['html'])
+
+    if spec['view'] not in VIEWS:
+        parser.error('unknown view {}'.format(spec['view']))
+    unknown_formats = set(spec['formats']) - set(TEXT_FORMATS + IMAGE_FORMATS)
+    if unknown_formats:
+        parser.error('unknown formats {}'.format(', '.join(sorted(unknown_formats))))
+    if not spec['periods']:
+        parser.error('no period to export, give --months or a spec with months or periods')
+    if set(spec['formats']) & set(IMAGE_FORMATS) and importlib.util.find_spec('kaleido') is None:
+        parser.error('image formats need the kaleido package')
+
+    index = metadata_index.MetadataIndex(
+        metadata_cache.read_metadata('./metadata/sensorMetadata.csv',
+                                     arguments.metadata_cache_dir),
+        metadata_cache.read_metadata('./metadata/BuildingMetadataAll.csv',
+                                     arguments.metadata_cache_dir),
+        [])
+    unknown_buildings = set(spec.get('buildings') or []) - set(index.building_sensors)
+    if unknown_buildings:
+        parser.error('no sensors for {}'.format(', '.join(sorted(unknown_buildings))))
+
+    if arguments.parquet_dir:
+        import parquet_source
+        client = parquet_source.ParquetSource(arguments.parquet_dir)
+    else:
+        from influx_pool import ManagedInfluxClient
+        client = ManagedInfluxClient(host=arguments.host, port=arguments.port,
+                                     username='root', password='root',
+                                     database=arguments.database)
+    store = rollup.RollupStore(arguments.rollup_dir) if arguments.rollup_dir else None
+
+    export_jobs = generate_jobs(index, spec.get('buildings'), spec.get('category_types'),
+                                spec['periods'])
+    n_written, n_failed = run_batch(client, index, export_jobs, spec['view'], spec['formats'],
+                                    arguments.output_dir, arguments.workers, store)
+    logger.info('%d diagrams written, %d failed', n_written, n_failed)
+    if n_failed:
+        raise SystemExit(1)
@@ -0,0 +1,331 @@
+import argparse
+import base64
+import json
+import re
+import resource
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+import pandas as pd
+import plotly.utils
+
+import generate_graph
+import utilities
+
+
+# Offline benchmark of the Sankey pipeline against a synthetic stand-in for DataFrameClient.
+#   python benchmark.py --buildings 150 --sensors 300 --save baseline.json
+#   python benchmark.py --buildings 150 --sensors 300 --compare baseline.json
+METRIC_LIST = ['Elec', 'Gas', 'HotWater']
+GROUPINGS = {'building_type_mod': 6, 'year_built_grouping': 5, 'area_grouping': 8}
+REGRESSION_THRESHOLD = 1.25
+# Stages this much slower or less are treated as timer noise
+MIN_REGRESSION_MS = 1.0
+
+# The colors of the app, so that the timed and checked figures are the ones it draws
+COLOR_DICT = generate_graph.COLOR_DICT
+
+
+def generate_synthetic_metadata(n_buildings, n_sensors, n_categories, seed=0):
+    rng = np.random.default_rng(seed)
+    building_list = ['Building_{:03d}'.format(i) for i in range(n_buildings)]
+
+    building_metadata = pd.DataFrame({'building': building_list})
+    for grouping, n_groups in GROUPINGS.items():
+        building_metadata[grouping] = ['{}-{}'.format(grouping, group)
+                                       for group in rng.integers(0, n_groups, n_buildings)]
+
+    sensor_rows = []
+    for building in building_list:
+        for i in range(n_sensors):
+            sensor_rows.append({'building': building,
+                                'sensor_short_id': '{}_Sensor_{:04d}'.format(building, i),
+                                'category_end_use': 'END_USE_{:02d}'.format(
+                                    rng.integers(0, n_categories))})
+    sensor_metadata = pd.DataFrame(sensor_rows)
+
+    return sensor_metadata, building_metadata
+
+
+class SyntheticInfluxClient:
+    # Answers `select sum(*) from <measurements>` like DataFrameClient: one frame per
+    # measurement with a single row of 'sum_<field>' columns. Results are generated once per
+    # (measurements, range) and copied on every call so that generation is not timed.
+    def __init__(self, sensor_metadata, building_metadata, seed=0):
+        self.seed = seed
+        self.building_list = list(building_metadata.building)
+        self.building_sensors = {building: list(sensors) for building, sensors
+                                 in sensor_metadata.groupby('building').sensor_short_id}
+        self._results = {}
+
+    def _generate_measurement(self, measurement, start_date):
+        if measurement in METRIC_LIST:
+            columns = self.building_list
+        else:
+            columns = self.building_sensors.get(measurement.replace('simulation_', ''), [])
+        rng = np.random.default_rng(
+            zlib.crc32('{}/{}/{}'.format(self.seed, measurement, start_date).encode('utf-8')))
+        values = rng.gamma(2.0, 500.0, len(columns))
+        values[rng.random(len(columns)) < 0.1] = 0.0
+        return pd.DataFrame([values], columns=['sum_' + col_name for col_name in columns],
+                            index=pd.to_datetime([start_date]))
+
+    def query(self, query, bind_params=None, **kwargs):
+        measurements = [measurement.strip().strip('"') for measurement
+                        in re.search(r'from (.*) where', query).group(1).split(',')]
+        key = (tuple(measurements), bind_params['t0'], bind_params['t1'])
+        if key not in self._results:
+            self._results[key] = {measurement: self._generate_measurement(measurement,
+                                                                          bind_params['t0'])
+                                  for measurement in measurements}
+
+        # Projected queries name their fields 'sum("<field>") as "<field>"'
+        fields = re.findall(r'sum\("([^"]*)"\) as', query)
+        if not fields:
+            return {measurement: frame.copy()
+                    for measurement, frame in self._results[key].items()}
+        projected_columns = ['sum_' + field for field in fields]
+        query_result = {}
+        for measurement, frame in self._results[key].items():
+            projected = frame.loc[:, frame.columns.isin(projected_columns)].copy()
+            projected.columns = [col_name[len('sum_'):] for col_name in projected.columns]
+            query_result[measurement] = projected
+        return query_result
+
+
+def generate_date_periods(n_periods):
+    end = pd.Timestamp('2020-11-01')
+    date_periods = []
+    for i in range(n_periods):
+        period_end = end - pd.DateOffset(months=i)
+        period_start = period_end - pd.DateOffset(months=1)
+        date_periods.append((period_start.strftime('%Y-%m-%d'), period_end.strftime('%Y-%m-%d')))
+    return date_periods
+
+
+def measure(stage_function, repeat):
+    # Wall time of every run, then one traced run for the allocation figures
+    wall_times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = stage_function()
+        wall_times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    stage_function()
+    _, peak_allocated = tracemalloc.get_traced_memory()
+    allocations = sum(stat.count for stat in tracemalloc.take_snapshot().statistics('filename'))
+    tracemalloc.stop()
+
+    return result, {'wall_min_ms': min(wall_times) * 1000,
+                    'wall_median_ms': statistics.median(wall_times) * 1000,
+                    'peak_allocated_kb': peak_allocated / 1024,
+                    'live_allocations': allocations,
+                    'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def run_benchmark(n_buildings, n_sensors, n_categories, n_periods, n_selected, repeat):
+    sensor_metadata, building_metadata = generate_synthetic_metadata(n_buildings, n_sensors,
+                                                                     n_categories)
+    client = SyntheticInfluxClient(sensor_metadata, building_metadata)
+    date_periods = generate_date_periods(n_periods)
+    selected_buildings = list(building_metadata.building[:n_selected])
+    selected_metadata = sensor_metadata[sensor_metadata.building.isin(selected_buildings)]
+    building_list_sim = utilities.generate_building_list_sim(selected_buildings)
+    results = {}
+
+    def time_stage(name, stage_function):
+        value, results[name] = measure(stage_function, repeat)
+        return value
+
+    time_stage('query_assembly',
+               lambda: utilities.generate_string_from_array(building_list_sim))
+
+    # Prime the synthetic results so that only the reshaping is timed
+    generate_graph.generate_dates_query(client, METRIC_LIST, date_periods)
+    generate_graph.generate_dates_query(client, building_list_sim, date_periods[:1])
+    campus_query = time_stage('result_reshaping_campus',
+                              lambda: generate_graph.generate_dates_query(client, METRIC_LIST,
+                                                                          date_periods))
+    building_query = time_stage('result_reshaping_building',
+                                lambda: generate_graph.generate_dates_query(client,
+                                                                            building_list_sim,
+                                                                            date_periods[:1]))
+
+    campus_elements = time_stage(
+        'elements_campus',
+        lambda: generate_graph.generate_sankey_elements_campus(campus_query, METRIC_LIST,
+                                                               building_metadata,
+                                                               'building_type_mod', 20,
+                                                               COLOR_DICT))
+    time_stage('elements_building',
+               lambda: generate_graph.generate_sankey_elements_building(building_query,
+                                                                        selected_metadata,
+                                                                        'category_end_use',
+                                                                        COLOR_DICT))
+    time_stage('elements_simulation',
+               lambda: generate_graph.generate_sankey_elements_simulation(building_query,
+                                                                          selected_metadata,
+                                                                          'category_end_use',
+                                                                          COLOR_DICT))
+
+    campus_figure = time_stage('figure_campus',
+                               lambda: generate_graph.generate_sankey_figure(campus_elements))
+    time_stage('figure_json_campus', lambda: campus_figure.to_json())
+    campus_figure_dict = time_stage(
+        'figure_dict_campus', lambda: generate_graph.generate_sankey_figure_dict(campus_elements))
+    # PlotlyJSONEncoder is in plotly 4 as well as 5, to_json_plotly only in 5
+    time_stage('figure_dict_json_campus',
+               lambda: json.dumps(campus_figure_dict, cls=plotly.utils.PlotlyJSONEncoder))
+
+    return results
+
+
+def normalize_figure(value):
+    # Plain JSON values, arrays and tuples as lists, to compare figures built either way.
+    # Recent plotly versions hold numeric arrays as {'dtype': ..., 'bdata': <base64>}.
+    if isinstance(value, dict) and 'bdata' in value:
+        array = np.frombuffer(base64.b64decode(value['bdata']), dtype=value['dtype'])
+        return array.tolist()
+    if isinstance(value, dict):
+        return {key: normalize_figure(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple, np.ndarray)):
+        return [normalize_figure(item) for item in value]
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def check_figure_dict(n_buildings, n_sensors, n_categories, n_periods, n_selected):
+    # The plain dict figures must be those of the plotly object model, its default template
+    # aside. Returns the names of the views that differ.
+    sensor_metadata, building_metadata = generate_synthetic_metadata(n_buildings, n_sensors,
+                                                                     n_categories)
+    client = SyntheticInfluxClient(sensor_metadata, building_metadata)
+    date_periods = generate_date_periods(n_periods)
+    selected_buildings = list(building_metadata.building[:n_selected])
+    selected_metadata = sensor_metadata[sensor_metadata.building.isin(selected_buildings)]
+    building_list_sim = utilities.generate_building_list_sim(selected_buildings)
+    campus_query = generate_graph.generate_dates_query(client, METRIC_LIST, date_periods)
+    building_query = generate_graph.generate_dates_query(client, building_list_sim,
+                                                         date_periods[:1])
+
+    rng = np.random.default_rng(0)
+    interval_labels = ['2020-{:02d}'.format(month) for month in range(1, 7)]
+    interval_values = rng.gamma(2.0, 500.0, (len(interval_labels), len(METRIC_LIST),
+                                             n_buildings))
+    interval_values[rng.random(interval_values.shape) < 0.1] = np.nan
+
+    views = {
+        'campus': generate_graph.generate_sankey_elements_campus(
+            campus_query, METRIC_LIST, building_metadata, 'building_type_mod', 20, COLOR_DICT),
+        'building': generate_graph.generate_sankey_elements_building(
+            building_query, selected_metadata, 'category_end_use', COLOR_DICT),
+        'simulation': generate_graph.generate_sankey_elements_simulation(
+            building_query, selected_metadata, 'category_end_use', COLOR_DICT),
+        'frames': generate_graph.generate_sankey_elements_frames(
+            interval_labels, interval_values, list(building_metadata.building), METRIC_LIST,
+            building_metadata, 'building_type_mod', 20, COLOR_DICT)}
+
+    mismatches = []
+    for view, element_dict in views.items():
+        expected = normalize_figure(
+            generate_graph.generate_sankey_figure(element_dict).to_plotly_json())
+        expected['layout'].pop('template', None)
+        if not expected.get('frames'):
+            expected.pop('frames', None)
+        figure_dict = normalize_figure(generate_graph.generate_sankey_figure_dict(element_dict))
+        if figure_dict != expected:
+            mismatches.append(view)
+    return mismatches
+
+
+def get_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return 'unknown'
+
+
+def compare_to_baseline(results, baseline):
+    regressions = []
+    print('{:<28}{:>14}{:>14}{:>10}'.format('stage', 'baseline ms', 'current ms', 'ratio'))
+    for stage, stage_result in results.items():
+        if stage not in baseline['stages']:
+            continue
+        baseline_ms = baseline['stages'][stage]['wall_min_ms']
+        ratio = stage_result['wall_min_ms'] / baseline_ms if baseline_ms > 0 else 1.0
+        print('{:<28}{:>14.2f}{:>14.2f}{:>10.2f}'.format(stage, baseline_ms,
+                                                         stage_result['wall_min_ms'], ratio))
+        if ratio > REGRESSION_THRESHOLD and \
+                stage_result['wall_min_ms'] - baseline_ms > MIN_REGRESSION_MS:
+            regressions.append(stage)
+    return regressions
+
+
+def print_results(results):
+    print('{:<28}{:>12}{:>12}{:>14}{:>12}{:>12}'.format('stage', 'min ms', 'median ms',
+                                                        'peak alloc kB', 'live allocs',
+                                                        'rss kB'))
+    for stage, stage_result in results.items():
+        print('{:<28}{:>12.2f}{:>12.2f}{:>14.0f}{:>12}{:>12}'.format(
+            stage, stage_result['wall_min_ms'], stage_result['wall_median_ms'],
+            stage_result['peak_allocated_kb'], stage_result['live_allocations'],
+            stage_result['peak_rss_kb']))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the Sankey pipeline offline')
+    parser.add_argument('--buildings', type=int, default=150)
+    parser.add_argument('--sensors', type=int, default=100, help='sensors per building')
+    parser.add_argument('--categories', type=int, default=12)
+    parser.add_argument('--periods', type=int, default=2)
+    parser.add_argument('--selected', type=int, default=5,
+                        help='buildings selected in the building and simulation views')
+    parser.add_argument('--repeat', type=int, default=10)
+    parser.add_argument('--save', help='write the results to this baseline file')
+    parser.add_argument('--compare', help='compare the results to this baseline file')
+    parser.add_argument('--check', action='store_true',
+                        help='only check the plain dict figures against the plotly figures')
+    arguments = parser.parse_args()
+
+    if arguments.check:
+        mismatched_views = check_figure_dict(arguments.buildings, arguments.sensors,
+                                             arguments.categories, arguments.periods,
+                                             arguments.selected)
+        if mismatched_views:
+            print('Plain dict figures differ: {}'.format(', '.join(mismatched_views)))
+            sys.exit(1)
+        print('Plain dict figures match the plotly figures')
+        sys.exit(0)
+
+    parameters = {'buildings': arguments.buildings, 'sensors': arguments.sensors,
+                  'categories': arguments.categories, 'periods': arguments.periods,
+                  'selected': arguments.selected}
+    benchmark_results = run_benchmark(arguments.buildings, arguments.sensors,
+                                      arguments.categories, arguments.periods,
+                                      arguments.selected, arguments.repeat)
+    print_results(benchmark_results)
+
+    if arguments.save:
+        with open(arguments.save, 'w') as baseline_file:
+            json.dump({'commit': get_commit(), 'parameters': parameters,
+                       'stages': benchmark_results}, baseline_file, indent=2)
+
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            baseline_results = json.load(baseline_file)
+        if baseline_results['parameters'] != parameters:
+            print('Warning: baseline was recorded with {}'.format(baseline_results['parameters']))
+        print('\nCompared to {}:'.format(baseline_results['commit']))
+        regressed_stages = compare_to_baseline(benchmark_results, baseline_results)
+        if regressed_stages:
+            print('Regressions over {:.0%}: {}'.format(REGRESSION_THRESHOLD - 1,
+                                                       ', '.join(regressed_stages)))
+            sys.exit(1)
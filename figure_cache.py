@@ -0,0 +1,99 @@
+import hashlib
+import json
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+
+
+def normalize_selection(selection):
+    # Dropdowns send None or [] when cleared, and the selection order never changes the figure
+    if not selection:
+        return None
+    return sorted(selection)
+
+
+def generate_date_periods_key(date_periods):
+    unique_periods = []
+    for start_date, end_date in date_periods:
+        period = [start_date[:10], end_date[:10]]
+        if period not in unique_periods:
+            unique_periods.append(period)
+    return unique_periods
+
+
+def generate_figure_key(*normalized_inputs):
+    key_string = json.dumps(normalized_inputs, sort_keys=True, default=str)
+    return hashlib.sha256(key_string.encode('utf-8')).hexdigest()
+
+
+class FigureCache:
+    # Finished figures keyed on the normalized callback inputs. Concurrent requests for a key
+    # that is being computed wait for that single computation instead of starting their own.
+    # When the computation is cancelled for its own request, the waiting ones compute again.
+    def __init__(self, max_entries=128, ttl=300):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._entries = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def get_or_compute(self, key, compute_function, closed=False):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and (entry[0] is None or entry[0] > time.time()):
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+
+            flight = self._in_flight.get(key)
+            if flight is None:
+                flight = {'done': threading.Event(), 'figure': None, 'error': None}
+                self._in_flight[key] = flight
+                leader = True
+                self.misses += 1
+            else:
+                leader = False
+                self.coalesced += 1
+
+        if not leader:
+            flight['done'].wait()
+            if isinstance(flight['error'], CancelledError):
+                return self.get_or_compute(key, compute_function, closed)
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['figure']
+
+        try:
+            flight['figure'] = compute_function()
+        except BaseException as error:
+            # KeyboardInterrupt and the like included, so that no figure is cached
+            flight['error'] = error
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+                if flight['error'] is None:
+                    expires_at = None if closed else time.time() + self.ttl
+                    self._entries[key] = (expires_at, flight['figure'])
+                    self._entries.move_to_end(key)
+                    while len(self._entries) > self.max_entries:
+                        self._entries.popitem(last=False)
+            flight['done'].set()
+
+        return flight['figure']
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'coalesced': self.coalesced,
+                    'entries': len(self._entries),
+                    'in_flight': len(self._in_flight)}
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
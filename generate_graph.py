@@ -1,268 +1,595 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
 import pandas as pd
-import plotly.graph_objects as go
 import numpy as np
+import influx_stream
+import metrics
+import rollup
+import sankey_layout
+import simulation_comparison
 import utilities
 
 
-def generate_influx_query(influx_client, start_date, end_date, measurements_list):
+# Concurrent date-range queries share one pool per process, created on first use so that
+# gunicorn forks its workers before any thread is started
+MAX_QUERY_WORKERS = 4
+query_executor = None
+
+# Fields per query when the select lists the fields explicitly
+MAX_PROJECTED_FIELDS = 200
+
+# Colors of the Sankey elements, shared by the app and the batch export
+COLOR_DICT = {'node': {1: 'rgba(0, 172, 0, 1.0)',
+                       2: 'rgba(224, 0, 188, 1.0)',
+                       'real': 'rgba(100, 100, 100, 1.0)',
+                       'simulation': 'rgba(100, 100, 100, 0.5)',
+                       'building': 'rgba(177, 177, 177, 1.0)',
+                       'category': 'rgba(85, 85, 85, 1.0)',
+                       'group': 'rgba(85, 85, 85, 1.0)',
+                       'Elec': 'rgba(205, 52, 181, 1.0)',
+                       'HotWater': 'rgba(255, 177, 78, 1.0)',
+                       'Gas': 'rgba(0, 0, 255, 1.0)',
+                       },
+              'link': {'Elec': 'rgba(205, 52, 181, 0.2)',
+                       'HotWater': 'rgba(255, 177, 78, 0.2)',
+                       'Gas': 'rgba(0, 0, 255, 0.2)',
+                       1: {'real': 'rgba(177, 177, 177, 0.4)',
+                           'simulation': 'rgba(0, 172, 0, 0.1)'},
+                       2: {'real': 'rgba(224, 0, 188, 0.4)',
+                           'simulation': 'rgba(224, 0, 188, 0.1)'},
+                       'green': 'rgba(0, 172, 0, 0.4)',
+                       'red': 'rgba(224, 0, 30, 0.4)'}}
+
+# Kinds of the nodes of the building and simulation views, indexing their attribute arrays
+NODE_BUILDING = 0
+NODE_BUILDING_SIMULATION = 1
+NODE_CATEGORY = 2
+NODE_CATEGORY_SIMULATION = 3
+
+# Links carrying this value or less are left out of the building and simulation views
+MIN_LINK_VALUE = 0.0
+
+
+@metrics.timed('influx_query')
+def generate_influx_query(influx_client, start_date, end_date, measurements_list,
+                          query_cache=None, rollup_store=None, columns=None):
+    # columns limits the query to these fields, None reads every field with sum(*)
+    if columns is not None:
+        columns = sorted(set(columns))
+
+    if query_cache is not None:
+        return query_cache.get_or_query(measurements_list, start_date, end_date,
+                                        lambda: generate_range_sums(influx_client,
+                                                                    start_date, end_date,
+                                                                    measurements_list,
+                                                                    rollup_store, columns),
+                                        None if columns is None else tuple(columns))
+
+    return generate_range_sums(influx_client, start_date, end_date, measurements_list,
+                               rollup_store, columns)
+
+
+def generate_range_sums(influx_client, start_date, end_date, measurements_list,
+                        rollup_store=None, columns=None):
+    if rollup_store is not None:
+        query_result_df = generate_rollup_query(influx_client, start_date, end_date,
+                                                measurements_list, rollup_store, columns)
+    else:
+        query_result_df = query_range_sums(influx_client, start_date, end_date,
+                                           measurements_list, columns=columns)
+
+    # Projected fields come back even when the measurement has no such field,
+    # drop them so the result matches what sum(*) would return
+    if columns is not None:
+        query_result_df = query_result_df.dropna(axis=1, how='all')
+    return query_result_df
+
+
+@metrics.timed('influx_request')
+def query_range_sums(influx_client, start_date, end_date, measurements_list,
+                     end_inclusive=True, columns=None):
+    # Other data sources than influx (see parquet_source.py) expose
+    # range_sums(start_date, end_date, measurements_list, end_inclusive, columns) returning
+    # this same measurements x fields frame
+    if hasattr(influx_client, 'range_sums'):
+        return influx_client.range_sums(start_date, end_date, measurements_list, end_inclusive,
+                                        columns)
+
+    if columns is None:
+        return query_field_sums(influx_client, start_date, end_date, measurements_list,
+                                end_inclusive)
+
+    # Long field lists are split so the query string stays reasonably small
+    column_batches = [columns[i:i + MAX_PROJECTED_FIELDS]
+                      for i in range(0, len(columns), MAX_PROJECTED_FIELDS)]
+    if len(column_batches) == 0:
+        return pd.DataFrame(index=measurements_list)
+    return pd.concat([query_field_sums(influx_client, start_date, end_date, measurements_list,
+                                       end_inclusive, column_batch)
+                      for column_batch in column_batches], axis=1)
+
+
+def query_field_sums(influx_client, start_date, end_date, measurements_list,
+                     end_inclusive=True, columns=None):
     where_parameters = {'t0': start_date,
                         't1': end_date}
 
-    measurements_string = utilities.generate_string_from_array(measurements_list)
+    measurements_string = utilities.generate_string_from_array(
+        [utilities.quote_identifier(measurement) for measurement in measurements_list])
+    if columns is None:
+        select_string = 'sum(*)'
+    else:
+        select_string = utilities.generate_projected_sums(columns)
 
-    query_influx = 'select sum(*) from {} where time>=$t0 and time<=$t1'. \
-        format(measurements_string)
+    query_influx = 'select {} from {} where time>=$t0 and time{}$t1'. \
+        format(select_string, measurements_string, '<=' if end_inclusive else '<')
 
-    query_result = influx_client.query(query_influx, bind_params=where_parameters)
-    query_result_df = pd.DataFrame()
+    # Real influx clients stream the chunked response straight into the result matrix,
+    # allocated upfront when the fields are known
+    if hasattr(influx_client, 'request'):
+        series_iterator = influx_stream.stream_query_series(influx_client, query_influx,
+                                                            where_parameters)
+        return influx_stream.generate_sum_matrix(series_iterator, measurements_list, columns)
 
+    query_result = influx_client.query(query_influx, bind_params=where_parameters)
+    measurement_frames = []
     for measurement in measurements_list:
-        query_result[measurement].columns = [col_name.replace('sum_', '')
-                                             for col_name
-                                             in query_result[measurement].columns]
-        query_result_df = query_result_df.append(query_result[measurement])
+        if measurement in query_result:
+            measurement_df = query_result[measurement]
+            if columns is None:
+                measurement_df.columns = [utilities.strip_sum_prefix(col_name)
+                                          for col_name in measurement_df.columns]
+        else:
+            measurement_df = pd.DataFrame(index=[measurement])
+        measurement_frames.append(measurement_df)
+
+    query_result_df = pd.concat(measurement_frames)
     query_result_df.index = measurements_list
+    if columns is not None:
+        query_result_df = query_result_df.reindex(columns=columns)
 
     return query_result_df
 
 
-def generate_dates_query(influx_client, metric_list,
-                         start_date_1, end_date_1,
-                         start_date_2, end_date_2):
+def generate_rollup_query(influx_client, start_date, end_date, measurements_list, rollup_store,
+                          columns=None):
+    # Whole days come from the prefix sums of the rollup, influx is only asked for the edges
+    range_plan = rollup_store.plan_range(measurements_list, start_date, end_date)
+    if range_plan is None:
+        return query_range_sums(influx_client, start_date, end_date, measurements_list,
+                                columns=columns)
+
+    first_day, end_day, edges = range_plan
+    query_result_df = rollup_store.range_sum(measurements_list, first_day, end_day)
+    if columns is not None:
+        query_result_df = query_result_df.reindex(columns=columns)
+    for edge_start, edge_end, end_inclusive in edges:
+        edge_df = query_range_sums(influx_client, edge_start, edge_end,
+                                   measurements_list, end_inclusive, columns)
+        query_result_df = query_result_df.add(edge_df, fill_value=0)
+
+    return query_result_df.reindex(measurements_list)
+
+
+def generate_date_range_label(start_date, end_date):
+    return start_date[:10] + ' to ' + end_date[:10]
+
+
+@metrics.timed('dates_query')
+def generate_dates_query(influx_client, metric_list, date_periods,
+                         query_cache=None, rollup_store=None, columns=None):
+    # date_periods is a list of (start_date, end_date); identical periods are queried once
+    # and the remaining ones run concurrently
+    query_periods = {}
+    for start_date, end_date in date_periods:
+        date_range = generate_date_range_label(start_date, end_date)
+        if date_range not in query_periods:
+            query_periods[date_range] = (start_date, end_date)
+
+    def query_period(date_range):
+        start_date, end_date = query_periods[date_range]
+        return generate_influx_query(influx_client, start_date, end_date,
+                                     metric_list, query_cache, rollup_store, columns)
+
+    date_ranges = list(query_periods.keys())
+    if len(date_ranges) == 1:
+        query_results = [query_period(date_ranges[0])]
+    else:
+        # Each period runs in a copy of the caller's context so its spans keep the view label
+        contexts = [contextvars.copy_context() for _ in date_ranges]
+        query_results = list(get_query_executor().map(
+            lambda context, date_range: context.run(query_period, date_range),
+            contexts, date_ranges))
+
+    return dict(zip(date_ranges, query_results))
+
+
+def generate_top_n_from_rollup(influx_client, rollup_store, metric_list, date_periods,
+                               building_list, n):
+    # Ranks the buildings on the sums of every period: whole days from the rollup, the edges
+    # and the days after its watermark from influx, projected on the buildings. Returns the top
+    # n buildings and, by period, the sums of the other buildings for the 'Other' nodes, or
+    # None when the rollup does not cover one of the periods.
+    building_totals = pd.Series(0.0, index=building_list)
+    range_results = {}
+    for start_date, end_date in date_periods:
+        if rollup_store.plan_range(metric_list, start_date, end_date) is None:
+            return None
+        range_df = generate_rollup_query(influx_client, start_date, end_date, metric_list,
+                                         rollup_store, list(building_list))
+        range_results[generate_date_range_label(start_date, end_date)] = range_df
+        building_totals += range_df.sum(axis=0)
+
+    top_n_building = list(building_totals.sort_values(ascending=False).index[:n])
+    other_result_dates = {date_range: range_df.drop(columns=top_n_building)
+                          for date_range, range_df in range_results.items()}
+    return top_n_building, other_result_dates
+
+
+def join_query_results(query_result_dates, other_result_dates):
+    # Columns of other_result_dates added to the query results of the same periods
+    return {date_range: pd.concat((query_result,
+                                   other_result_dates[date_range].reindex(query_result.index)),
+                                  axis=1)
+            for date_range, query_result in query_result_dates.items()}
+
+
+def generate_building_groups(metadata, buildings, max_fields=MAX_PROJECTED_FIELDS):
+    # Consecutive buildings whose sensors fit in one projected query, so that a query only
+    # asks the measurements of a building for its own sensors
+    groups = [[]]
+    n_fields = 0
+    for building in buildings:
+        n_sensors = len(metadata.building_sensors[building])
+        if groups[-1] and n_fields + n_sensors > max_fields:
+            groups.append([])
+            n_fields = 0
+        groups[-1].append(building)
+        n_fields += n_sensors
+    return [group for group in groups if group]
+
+
+def query_buildings(influx_client, metadata, period, buildings, rollup_store=None):
+    # Sums of every sensor of the buildings and their simulations over the period, at once
+    building_list_sim = utilities.generate_building_list_sim(buildings)
+    sensor_list = np.concatenate([metadata.building_sensors[building] for building in buildings])
+    query_result_dates = generate_dates_query(influx_client, building_list_sim, [period], None,
+                                              rollup_store, sensor_list)
+    return next(iter(query_result_dates.values()))
+
+
+def query_simulation_comparison(influx_client, metadata, category_type, periods, buildings,
+                                rollup_store=None):
+    # Every period read once for all the buildings, in groups of buildings whose sensors fit
+    # in one query
     query_result_dates = {}
+    for period in periods:
+        query_results = [query_buildings(influx_client, metadata, period, building_group,
+                                         rollup_store)
+                         for building_group in generate_building_groups(metadata, buildings)]
+        query_result_dates[generate_date_range_label(*period)] = pd.concat(query_results)
+    sensor_metadata = metadata.filter_sensor_metadata(category_type, None, buildings)
+    return simulation_comparison.generate_simulation_comparison(query_result_dates,
+                                                                sensor_metadata, category_type)
+
+
+@metrics.timed('interval_query')
+def generate_interval_query(influx_client, start_date, end_date, measurements_list, interval,
+                            query_cache=None, columns=None):
+    # Sums of every interval ('day', 'week' or 'month') of the range, fetched with one daily
+    # group by query. Returns the interval labels, the interval x measurement x column array
+    # and the column list.
+    if columns is not None:
+        columns = sorted(set(columns))
+
+    if query_cache is not None:
+        return query_cache.get_or_query(measurements_list, start_date, end_date,
+                                        lambda: generate_interval_sums(influx_client,
+                                                                       start_date, end_date,
+                                                                       measurements_list,
+                                                                       interval, columns),
+                                        'interval', interval,
+                                        None if columns is None else tuple(columns))
+
+    return generate_interval_sums(influx_client, start_date, end_date, measurements_list,
+                                  interval, columns)
+
+
+def generate_interval_sums(influx_client, start_date, end_date, measurements_list, interval,
+                           columns=None):
+    days, daily_values, columns = query_daily_sums(influx_client, start_date, end_date,
+                                                   measurements_list, columns)
+
+    # The range ends on end_date at midnight included, that last instant joins the last interval
+    interval_days = days
+    if len(days) > 1 and rollup.floor_day(end_date) == rollup.to_utc_timestamp(end_date):
+        interval_days = days[:-1]
+    if interval == 'week':
+        starts = np.nonzero(interval_days.dayofweek == 0)[0]
+    elif interval == 'month':
+        starts = np.nonzero(interval_days.day == 1)[0]
+    else:
+        starts = np.arange(len(interval_days))
+    starts = np.union1d([0], starts).astype(int)
 
-    query_result_1 = generate_influx_query(influx_client,
-                                           start_date_1, end_date_1,
-                                           metric_list)
-    query_result_2 = generate_influx_query(influx_client,
-                                           start_date_2, end_date_2,
-                                           metric_list)
+    ends = np.append(starts[1:] - 1, len(days) - 1)
+    interval_labels = [generate_date_range_label(str(days[first].date()), str(days[last].date()))
+                       for first, last in zip(starts, ends)]
 
-    date_range_1 = start_date_1[:10] + ' to ' + end_date_1[:10]
-    date_range_2 = start_date_2[:10] + ' to ' + end_date_2[:10]
+    # Intervals without any value stay NaN like the range sums
+    counts = np.add.reduceat(~np.isnan(daily_values), starts, axis=0)
+    interval_values = np.add.reduceat(np.nan_to_num(daily_values), starts, axis=0)
+    interval_values[counts == 0] = np.nan
+    return interval_labels, interval_values, columns
 
-    query_result_dates[date_range_1] = query_result_1
-    query_result_dates[date_range_2] = query_result_2
 
-    return query_result_dates
+@metrics.timed('influx_request')
+def query_daily_sums(influx_client, start_date, end_date, measurements_list, columns=None):
+    # Returns the days, the day x measurement x column array of daily sums and the column list.
+    # Other data sources than influx expose daily_sums(start_date, end_date, measurements_list,
+    # columns) returning the same.
+    if hasattr(influx_client, 'daily_sums'):
+        return influx_client.daily_sums(start_date, end_date, measurements_list, columns)
 
+    days = pd.date_range(rollup.floor_day(start_date), rollup.floor_day(end_date), freq='D')
 
+    where_parameters = {'t0': start_date,
+                        't1': end_date}
+    measurements_string = utilities.generate_string_from_array(
+        [utilities.quote_identifier(measurement) for measurement in measurements_list])
+    if columns is None:
+        select_string = 'sum(*)'
+    else:
+        select_string = utilities.generate_projected_sums(columns)
+    query_influx = 'select {} from {} where time>=$t0 and time<=$t1 group by time(1d)'. \
+        format(select_string, measurements_string)
+    query_result = influx_client.query(query_influx, bind_params=where_parameters)
+
+    measurement_frames = {}
+    for measurement in measurements_list:
+        if measurement not in query_result:
+            continue
+        daily_df = query_result[measurement]
+        if daily_df.index.tz is not None:
+            daily_df.index = daily_df.index.tz_convert('UTC').tz_localize(None)
+        if columns is None:
+            daily_df.columns = [utilities.strip_sum_prefix(col_name)
+                                for col_name in daily_df.columns]
+        measurement_frames[measurement] = daily_df
+
+    if columns is None:
+        columns = list(pd.unique(np.concatenate(
+            [frame.columns.to_numpy(dtype=object) for frame in measurement_frames.values()] +
+            [np.empty(0, dtype=object)])))
+    daily_values = np.full((len(days), len(measurements_list), len(columns)), np.nan)
+    for i, measurement in enumerate(measurements_list):
+        if measurement in measurement_frames:
+            daily_values[:, i, :] = measurement_frames[measurement].reindex(
+                index=days, columns=columns).to_numpy(dtype=float)
+    return days, daily_values, columns
+
+
+def get_query_executor():
+    global query_executor
+    if query_executor is None:
+        query_executor = ThreadPoolExecutor(max_workers=MAX_QUERY_WORKERS,
+                                            thread_name_prefix='influx-query')
+    return query_executor
+
+
+def generate_node_colors(node_kinds, color_dict):
+    kind_colors = np.array([color_dict['node']['real'], color_dict['node']['simulation'],
+                            color_dict['node']['category'], color_dict['node']['simulation']],
+                           dtype=object)
+    return list(kind_colors[node_kinds])
+
+
+def generate_period_link_colors(color_dict, period_index):
+    # The link colors of the numbered periods, cycled when there are more periods than colors
+    period_keys = sorted(key for key in color_dict['link'] if isinstance(key, int))
+    return color_dict['link'][period_keys[period_index % len(period_keys)]]
+
+
+def prune_links(sources, targets, values, color_links, min_link_value):
+    # Links carrying min_link_value or less are dropped all at once
+    keep = np.abs(values) > min_link_value
+    return {'sources': sources[keep],
+            'targets': targets[keep],
+            'values': values[keep],
+            'color_links': list(np.asarray(color_links, dtype=object)[keep])}
+
+
+@metrics.timed('elements_simulation')
 def generate_sankey_elements_simulation(query_result_dates, sensor_metadata, category_type,
-                                        color_dict):
+                                        color_dict, min_link_value=MIN_LINK_VALUE,
+                                        layout_cache=None):
     category_list = sensor_metadata[category_type].unique()
     building_list = sensor_metadata.building.unique()
     building_sim_list = utilities.generate_building_list_sim(building_list)
     date_ranges = list(query_result_dates.keys())
 
+    # Each building is followed by its simulation, then come the categories
+    node_kinds = np.concatenate((np.tile([NODE_BUILDING, NODE_BUILDING_SIMULATION],
+                                         len(building_list)),
+                                 np.full(len(category_list), NODE_CATEGORY)))
     element_dict = {'labels': np.concatenate((building_sim_list,
                                               category_list), axis=None),
-                    'sources': [],
-                    'targets': [],
-                    'values': [],
-                    'color_nodes': [],
-                    'color_links': [],
-                    'x_values': [],
-                    'y_values': []}
-    date_range = date_ranges[0]
-    query_result = query_result_dates[date_range]
-    for building in building_list:
-        for category in category_list:
-            simulation_label = 'simulation_' + building
-            sensor_category_list = sensor_metadata[
-                sensor_metadata[category_type] == category].sensor_short_id
-            category_df = (query_result.loc[[building, simulation_label],
-                                            query_result.columns.isin(
-                                                sensor_category_list)])
-            sum_category = category_df.sum(axis=1)
-            real_value = sum_category[building]
-            simulation_error = real_value - sum_category[simulation_label]
-            if simulation_error > 0:
-                temp_color = 'green'
-            else:
-                temp_color = 'red'
-            element_dict['sources'].append(np.where(element_dict['labels']
-                                                    == building)[0][0])
-            element_dict['targets'].append(np.where(element_dict['labels']
-                                                    == category)[0][0])
-            element_dict['values'].append(real_value)
-            element_dict['color_links'].append(color_dict['link'][1]['real'])
-
-            element_dict['sources'].append(np.where(element_dict['labels']
-                                                    == simulation_label)[0][0])
-
-            element_dict['targets'].append(np.where(element_dict['labels']
-                                                    == category)[0][0])
-
-            element_dict['values'].append(np.abs(simulation_error))
-            element_dict['color_links'].append(color_dict['link'][temp_color])
-
-    for j in range(len(element_dict['labels'])):
-        element = element_dict['labels'][j]
-        if element in building_list:
-            color = color_dict['node']['real']
-        elif 'simulation' in element:
-            color = color_dict['node']['simulation']
-        elif element in category_list:
-            color = color_dict['node']['category']
-        else:
-            color = color_dict['node']['category']
+                    'color_nodes': generate_node_colors(node_kinds, color_dict)}
 
-        element_dict['color_nodes'].append(color)
+    # The diagram shows the comparison of the first period
+    date_range = date_ranges[0]
+    comparison = simulation_comparison.generate_simulation_comparison(
+        {date_range: query_result_dates[date_range]}, sensor_metadata, category_type)
+    building_position, category_position = np.nonzero((comparison['real'][0] != 0) |
+                                                      (comparison['simulation'][0] != 0))
+    real_sums = comparison['real'][0][building_position, category_position]
+    simulation_error = comparison['error'][0][building_position, category_position]
+
+    # Links are interleaved per building and category: real value, then simulation error
+    sources = np.stack((2 * building_position, 2 * building_position + 1), axis=-1).ravel()
+    targets = np.repeat(2 * len(building_list) + category_position, 2)
+    values = np.stack((real_sums, np.abs(simulation_error)), axis=-1).ravel()
+    error_colors = np.where(simulation_error > 0,
+                            color_dict['link']['green'], color_dict['link']['red'])
+    color_links = np.stack((np.full(len(real_sums), color_dict['link'][1]['real'], dtype=object),
+                            error_colors), axis=-1).ravel()
+    element_dict.update(prune_links(sources, targets, values, color_links, min_link_value))
+
+    # Buildings on the left, each one kept above its simulation, categories on the right
+    node_layers = (node_kinds == NODE_CATEGORY).astype(int)
+    node_blocks = np.concatenate((np.repeat(np.arange(len(building_list)), 2),
+                                  len(building_list) + np.arange(len(category_list))))
+    element_dict['x_values'], element_dict['y_values'] = sankey_layout.generate_layout(
+        element_dict['labels'], node_layers, element_dict['sources'], element_dict['targets'],
+        element_dict['values'], node_blocks, layout_cache)
 
     return element_dict
 
+
+@metrics.timed('elements_building')
 def generate_sankey_elements_building(query_result_dates, sensor_metadata, category_type,
-                                      color_dict):
+                                      color_dict, min_link_value=MIN_LINK_VALUE):
 
     category_list = sensor_metadata[category_type].unique()
     category_sim_list = utilities.generate_simulation_labels(category_list)
     date_ranges = list(query_result_dates.keys())
-    sensor_list = sensor_metadata.sensor_short_id
     building_list = sensor_metadata.building.unique()
     building_list_sim = utilities.generate_building_list_sim(building_list)
 
+    # Each building and category is followed by its simulation
+    node_kinds = np.concatenate((np.tile([NODE_BUILDING, NODE_BUILDING_SIMULATION],
+                                         len(building_list)),
+                                 np.tile([NODE_CATEGORY, NODE_CATEGORY_SIMULATION],
+                                         len(category_list))))
     element_dict = {'labels': np.concatenate((building_list_sim,
                                               category_sim_list), axis=None),
-                    'sources': [],
-                    'targets': [],
-                    'values': [],
-                    'color_nodes': [],
-                    'color_links': [],
-                    'x_values': [],
-                    'y_values': []}
-
-    i = 0
-    for date_range in date_ranges:
-        i += 1
+                    'color_nodes': generate_node_colors(node_kinds, color_dict)}
+
+    # Real buildings flow into the categories, simulations into the '_SIMULATION' categories
+    is_simulation = node_kinds[:len(building_list_sim)] == NODE_BUILDING_SIMULATION
+    sources = [np.empty(0, dtype=int)]
+    targets = [np.empty(0, dtype=int)]
+    values = [np.empty(0)]
+    color_links = [np.empty(0, dtype=object)]
+    for i, date_range in enumerate(date_ranges):
+        period_colors = generate_period_link_colors(color_dict, i)
         query_result = query_result_dates[date_range]
-        for building in building_list_sim:
-            if 'simulation' in building:
-                real_simulation = 'simulation'
-                suffix = '_SIMULATION'
-            else:
-                real_simulation = 'real'
-                suffix = ''
-
-            element_dict['color_links'].append(color_dict['link'][i][real_simulation])
-            for category in category_list:
-                sensor_category_list = sensor_metadata[
-                    sensor_metadata[category_type] == category].sensor_short_id
-
-                temp_df_category = (query_result.loc[building,
-                                                     query_result.columns.isin(
-                                                         sensor_category_list)])
-
-                if len(temp_df_category) > 0:
-                    # Add the values for the end_use
-                    element_dict['sources'].append(np.where(element_dict['labels']
-                                                            == building)[0][0])
-
-                    element_dict['targets'].append(np.where(element_dict['labels']
-                                                            == (category+suffix))[0][0])
-
-                    category_value = temp_df_category.sum()
-
-                    element_dict['values'].append(category_value)
-                    element_dict['color_links'].append(color_dict['link'][i][real_simulation])
-    y_temp = 0.0
-    delta_y = 1 / len(category_list)
-    for j in range(len(element_dict['labels'])):
-        element = element_dict['labels'][j]
-        if element in building_list:
-            color = color_dict['node']['real']
-            x = 0.0
-            y = 0.5
-        elif element in category_list:
-            color = color_dict['node']['category']
-            x = 0.9
-            y = y_temp
-        elif 'simulation' in element.lower():
-            color = color_dict['node']['simulation']
-            if element[11:] in building_list:
-                x = 0.05
-                y = 0.5
-            else:
-                x = 1.0
-                y = y_temp
-                y_temp = y_temp + delta_y
-                element_dict['labels'][j] = ''
-        else:
-            color = color_dict['node']['category']
-            x = 0.0
-            y = 0.0
-
-        element_dict['color_nodes'].append(color)
-        element_dict['x_values'].append(x)
-        element_dict['y_values'].append(y)
+        sensor_category = utilities.generate_indicator_matrix(sensor_metadata.sensor_short_id,
+                                                              sensor_metadata[category_type],
+                                                              query_result.columns, category_list)
+        rows, categories, category_values = utilities.generate_sparse_group_sums(
+            query_result, building_list_sim, sensor_category)
+
+        sources.append(rows)
+        targets.append(len(building_list_sim) + 2 * categories + is_simulation[rows])
+        values.append(category_values)
+        color_links.append(np.where(is_simulation[rows], period_colors['simulation'],
+                                    period_colors['real']))
+
+    element_dict.update(prune_links(np.concatenate(sources), np.concatenate(targets),
+                                    np.concatenate(values), np.concatenate(color_links),
+                                    min_link_value))
+
+    # Buildings on the left, each category pair on its own row on the right, with the labels
+    # of the simulated categories left out
+    kind_x = np.array([0.0, 0.05, 0.9, 1.0])
+    y_values = np.full(len(node_kinds), 0.5)
+    delta_y = 1 / max(len(category_list), 1)
+    category_y = np.cumsum(np.concatenate(([0.0], np.full(len(category_list), delta_y))))
+    y_values[len(building_list_sim):] = np.repeat(category_y[:-1], 2)
+    element_dict['labels'][node_kinds == NODE_CATEGORY_SIMULATION] = ''
+    element_dict['x_values'] = kind_x[node_kinds].tolist()
+    element_dict['y_values'] = y_values.tolist()
 
     return element_dict
 
 
+@metrics.timed('elements_campus')
 def generate_sankey_elements_campus(query_result_dates, metric_list, building_metadata,
                                     grouping_type, max_nodes,
-                                    color_dict):
+                                    color_dict, top_n_building=None, layout_cache=None):
 
     group_list = building_metadata[grouping_type].unique()
     date_ranges = list(query_result_dates.keys())
     building_list = building_metadata.building.unique()
-    if len(building_list) > max_nodes:
-        top_n_building = utilities.generate_top_n_list(query_result_dates, building_list, max_nodes)
-    else:
-        top_n_building = building_list
+    if top_n_building is None:
+        if len(building_list) > max_nodes:
+            top_n_building = utilities.generate_top_n_list(query_result_dates, building_list,
+                                                           max_nodes)
+        else:
+            top_n_building = building_list
+
+    # Buildings outside the top n are drawn as one 'Other' node per group
+    building_group = utilities.generate_indicator_matrix(building_metadata.building,
+                                                         building_metadata[grouping_type],
+                                                         building_list, group_list)
+    is_top_n = np.isin(building_list, top_n_building)
+    other_group = building_group & ~is_top_n[:, None]
+    has_other = other_group.any(axis=0)
+    other_list = np.array([utilities.generate_other_label(group) for group in group_list],
+                          dtype=object)
 
     element_dict = {'labels': np.concatenate((metric_list,
                                               date_ranges,
                                               group_list,
-                                              building_list), axis=None),
+                                              building_list[is_top_n],
+                                              other_list[has_other]), axis=None),
                     'sources': [],
                     'targets': [],
                     'values': [],
                     'color_nodes': [],
-                    'color_links': [],
-                    'x_values': [],
-                    'y_values': []}
+                    'color_links': []}
+    label_index = utilities.generate_label_index(element_dict['labels'])
+    building_index = np.array([label_index.get(building, -1) for building in building_list])
+
+    sources = [np.empty(0, dtype=int)]
+    targets = [np.empty(0, dtype=int)]
+    values = [np.empty(0)]
+    color_links = []
+
+    def add_links(source, target, value, color):
+        sources.append(np.ravel(np.broadcast_to(source, np.shape(value))))
+        targets.append(np.ravel(np.broadcast_to(target, np.shape(value))))
+        values.append(np.ravel(value).astype(float))
+        color_links.extend([color] * np.size(value))
 
     for date_range in date_ranges:
         query_result = query_result_dates[date_range]
-        for metric in metric_list:
+        building_values = (query_result.reindex(index=metric_list, columns=building_list)
+                           .fillna(0.0).to_numpy(dtype=float))
+        group_values = building_values @ building_group
+        other_values = building_values @ other_group
+
+        for m, metric in enumerate(metric_list):
+            link_color = color_dict['link'][metric]
 
             if len(date_ranges) > 1:
-                element_dict['sources'].append(np.where(element_dict['labels'] == metric)[0][0])
-                element_dict['targets'].append(np.where(element_dict['labels'] == date_range)[0][0])
-                temp_df_date = query_result.loc[metric, query_result.columns.isin(building_list)]
-                element_dict['values'].append(temp_df_date.sum())
-                element_dict['color_links'].append(color_dict['link'][metric])
-
-            for group in group_list:
-                building_group_list = building_metadata[building_metadata[
-                                                            grouping_type] == group].building
-                temp_df_group = query_result.loc[metric, query_result.columns.isin(building_group_list)]
-                if temp_df_group.sum() > 0:
-                    if len(date_ranges) > 1:
-                        source_lvl2 = date_range
-
-                    else:
-                        source_lvl2 = metric
-
-                    element_dict['sources'].append(
-                        np.where(element_dict['labels'] == source_lvl2)[0][0])
-                    element_dict['targets'].append(np.where(element_dict['labels'] == group)[0][0])
-                    group_value = temp_df_group.sum()
-                    element_dict['values'].append(group_value)
-                    element_dict['color_links'].append(color_dict['link'][metric])
-                    for col in temp_df_group.index:
-                        if (col in top_n_building) & (temp_df_group[col] > 0):
-
-                            element_dict['sources'].append(
-                                np.where(element_dict['labels'] == group)[0][0])
-                            element_dict['targets'].append(
-                                np.where(element_dict['labels'] == col)[0][0])
-                            element_dict['values'].append(temp_df_group[col])
-                            element_dict['color_links'].append(color_dict['link'][metric])
-
-    for i in range(len(element_dict['labels'])):
-        element = element_dict['labels'][i]
-        if element in list(building_list):
+                source_lvl2 = date_range
+                add_links(label_index[metric], label_index[date_range],
+                          building_values[m].sum(), link_color)
+            else:
+                source_lvl2 = metric
+
+            for g in np.nonzero(group_values[m] > 0)[0]:
+                group_label_index = label_index[group_list[g]]
+                add_links(label_index[source_lvl2], group_label_index,
+                          group_values[m, g], link_color)
+
+                in_group = building_group[:, g] & is_top_n & (building_values[m] > 0)
+                add_links(group_label_index, building_index[in_group],
+                          building_values[m, in_group], link_color)
+                if other_values[m, g] > 0:
+                    add_links(group_label_index, label_index[other_list[g]],
+                              other_values[m, g], link_color)
+
+    element_dict['sources'] = np.concatenate(sources)
+    element_dict['targets'] = np.concatenate(targets)
+    element_dict['values'] = np.concatenate(values)
+    element_dict['color_links'] = color_links
+
+    building_set = set(building_list[is_top_n]) | set(other_list[has_other])
+    for element in element_dict['labels']:
+        if element in building_set:
             color = color_dict['node']['building']
         elif element in metric_list:
             color = color_dict['node'][element]
@@ -272,10 +599,191 @@ def generate_sankey_elements_campus(query_result_dates, metric_list, building_me
 
         element_dict['color_nodes'].append(color)
 
+    # Metrics, periods, groups and buildings in columns. A single period has no links and is
+    # not drawn, it is left in the column of the metrics. The periods are named by their
+    # position in the layout key, so that other dates reuse the layout of the same nodes.
+    date_layer = 1 if len(date_ranges) > 1 else 0
+    node_layers = np.repeat([0, date_layer, 2, 3],
+                            [len(metric_list), len(date_ranges), len(group_list),
+                             is_top_n.sum() + has_other.sum()])
+    node_names = np.concatenate((metric_list,
+                                 ['period {}'.format(i) for i in range(len(date_ranges))],
+                                 element_dict['labels'][len(metric_list) + len(date_ranges):]),
+                                axis=None)
+    element_dict['x_values'], element_dict['y_values'] = sankey_layout.generate_layout(
+        node_names, node_layers, element_dict['sources'], element_dict['targets'],
+        element_dict['values'], layout_cache=layout_cache)
+
     return element_dict
 
 
+@metrics.timed('elements_frames')
+def generate_sankey_elements_frames(interval_labels, interval_values, columns, metric_list,
+                                    building_metadata, grouping_type, max_nodes, color_dict,
+                                    top_n_building=None, layout_cache=None):
+    # Campus view of every interval with one set of nodes and links shared by all the frames:
+    # the links are those with a value in any interval and only their values change
+    group_list = building_metadata[grouping_type].unique()
+    building_list = building_metadata.building.unique()
+
+    # interval x metric x building values, missing buildings and values count as zero
+    padded_values = np.concatenate((np.nan_to_num(interval_values),
+                                    np.zeros(interval_values.shape[:2] + (1,))), axis=2)
+    building_values = padded_values[:, :, pd.Index(columns).get_indexer(building_list)]
+    total_values = building_values.sum(axis=0)
+    if top_n_building is None:
+        if len(building_list) > max_nodes:
+            top_n_building = building_list[np.argsort(-total_values.sum(axis=0),
+                                                      kind='stable')[:max_nodes]]
+        else:
+            top_n_building = building_list
+
+    building_group = utilities.generate_indicator_matrix(building_metadata.building,
+                                                         building_metadata[grouping_type],
+                                                         building_list, group_list)
+    is_top_n = np.isin(building_list, top_n_building)
+    other_group = building_group & ~is_top_n[:, None]
+    has_other = other_group.any(axis=0)
+    other_list = np.array([utilities.generate_other_label(group) for group in group_list],
+                          dtype=object)
+
+    # Every link value of every frame is read from this interval x metric x column array
+    group_values = building_values @ building_group
+    other_values = building_values @ other_group
+    value_source = np.concatenate((group_values, other_values, building_values), axis=2)
+    total_group = group_values.sum(axis=0)
+    total_other = other_values.sum(axis=0)
+    n_groups = len(group_list)
+
+    element_dict = {'labels': np.concatenate((metric_list,
+                                              group_list,
+                                              building_list[is_top_n],
+                                              other_list[has_other]), axis=None),
+                    'sources': [],
+                    'targets': [],
+                    'values': [],
+                    'color_nodes': [],
+                    'color_links': []}
+    label_index = utilities.generate_label_index(element_dict['labels'])
+    building_index = np.array([label_index.get(building, -1) for building in building_list])
+
+    link_metrics = [np.empty(0, dtype=int)]
+    link_columns = [np.empty(0, dtype=int)]
+    sources = [np.empty(0, dtype=int)]
+    targets = [np.empty(0, dtype=int)]
+    color_links = []
+
+    def add_links(m, column, source, target, color):
+        column = np.ravel(column)
+        link_metrics.append(np.full(len(column), m))
+        link_columns.append(column)
+        sources.append(np.ravel(np.broadcast_to(source, column.shape)))
+        targets.append(np.ravel(np.broadcast_to(target, column.shape)))
+        color_links.extend([color] * len(column))
+
+    for m, metric in enumerate(metric_list):
+        link_color = color_dict['link'][metric]
+        for g in np.nonzero(total_group[m] > 0)[0]:
+            group_label_index = label_index[group_list[g]]
+            add_links(m, g, label_index[metric], group_label_index, link_color)
+
+            in_group = np.nonzero(building_group[:, g] & is_top_n & (total_values[m] > 0))[0]
+            add_links(m, 2 * n_groups + in_group, group_label_index, building_index[in_group],
+                      link_color)
+            if total_other[m, g] > 0:
+                add_links(m, n_groups + g, group_label_index, label_index[other_list[g]],
+                          link_color)
+
+    frame_values = value_source[:, np.concatenate(link_metrics), np.concatenate(link_columns)]
+    element_dict['sources'] = np.concatenate(sources)
+    element_dict['targets'] = np.concatenate(targets)
+    element_dict['values'] = frame_values[0]
+    element_dict['color_links'] = color_links
+    element_dict['frame_labels'] = list(interval_labels)
+    element_dict['frame_values'] = frame_values
+
+    building_set = set(building_list[is_top_n]) | set(other_list[has_other])
+    for element in element_dict['labels']:
+        if element in building_set:
+            color = color_dict['node']['building']
+        elif element in metric_list:
+            color = color_dict['node'][element]
+        else:
+            color = color_dict['node']['group']
+        element_dict['color_nodes'].append(color)
+
+    # Node positions from the totals of all the intervals, so that nodes do not move
+    node_layers = np.repeat([0, 1, 2], [len(metric_list), len(group_list),
+                                        is_top_n.sum() + has_other.sum()])
+    element_dict['x_values'], element_dict['y_values'] = sankey_layout.generate_layout(
+        element_dict['labels'], node_layers, element_dict['sources'], element_dict['targets'],
+        frame_values.sum(axis=0), layout_cache=layout_cache)
+
+    return element_dict
+
+
+def generate_animation_layout(frame_labels):
+    # Play button and slider over the frames, built the same way by assets/sankey_transport.js
+    frame_args = {'mode': 'immediate', 'frame': {'duration': 0, 'redraw': True},
+                  'transition': {'duration': 0}}
+    return {'sliders': [{'active': 0,
+                         'currentvalue': {'prefix': ''},
+                         'pad': {'t': 20},
+                         'steps': [{'label': label, 'method': 'animate',
+                                    'args': [[label], frame_args]}
+                                   for label in frame_labels]}],
+            'updatemenus': [{'type': 'buttons',
+                             'showactive': False,
+                             'x': 0, 'y': 0, 'xanchor': 'right', 'yanchor': 'top',
+                             'pad': {'t': 20, 'r': 10},
+                             'buttons': [{'label': 'Play', 'method': 'animate',
+                                          'args': [None, {'fromcurrent': True,
+                                                          'frame': {'duration': 700,
+                                                                    'redraw': True},
+                                                          'transition': {'duration': 0}}]}]}]}
+
+
+def generate_sankey_trace(element_dict):
+    # Sankey trace as plain data, numeric arrays already in the types plotly.js reads
+    return {'type': 'sankey',
+            'valuesuffix': ' kWh',
+            'node': {'pad': 15,
+                     'thickness': 20,
+                     'line': {'color': 'black', 'width': 0.5},
+                     'label': list(element_dict['labels']),
+                     'color': list(element_dict['color_nodes']),
+                     'x': np.asarray(element_dict['x_values'], dtype=float),
+                     'y': np.asarray(element_dict['y_values'], dtype=float)},
+            'link': {'source': np.asarray(element_dict['sources'], dtype=int),
+                     'target': np.asarray(element_dict['targets'], dtype=int),
+                     'value': np.asarray(element_dict['values'], dtype=float),
+                     'color': list(element_dict['color_links'])}}
+
+
+@metrics.timed('sankey_figure')
+def generate_sankey_figure_dict(element_dict):
+    # Same figure as generate_sankey_figure without the plotly object model and its validation,
+    # `python benchmark.py --check` compares the two
+    sankey_trace = generate_sankey_trace(element_dict)
+    sankey_figure = {'data': [sankey_trace],
+                     'layout': {'margin': {'l': 10, 'r': 100, 'b': 30, 't': 0, 'pad': 0}}}
+
+    if 'frame_values' in element_dict:
+        frame_values = np.asarray(element_dict['frame_values'], dtype=float)
+        sankey_figure['frames'] = [
+            {'name': label,
+             'data': [dict(sankey_trace, link=dict(sankey_trace['link'],
+                                                   value=frame_values[f]))]}
+            for f, label in enumerate(element_dict['frame_labels'])]
+        sankey_figure['layout']['margin']['b'] = 120
+        sankey_figure['layout'].update(generate_animation_layout(element_dict['frame_labels']))
+
+    return sankey_figure
+
+
 def generate_sankey_figure(element_dict):
+    # Validated plotly figure, for the tools working on figure objects
+    import plotly.graph_objects as go
 
     sankey_data = go.Sankey(
         valuesuffix=" kWh",
@@ -300,5 +808,12 @@ def generate_sankey_figure(element_dict):
     sankey_figure = go.Figure(data=[sankey_data])
     sankey_figure.update_layout(margin=dict(l=10, r=100, b=30, t=0, pad=0))
 
-    return sankey_figure
+    # Time-resolved views get one frame per interval, only the link values change
+    if 'frame_values' in element_dict:
+        sankey_figure.frames = [go.Frame(name=label, data=[go.Sankey(sankey_data).update(
+            link=dict(value=element_dict['frame_values'][f]))])
+            for f, label in enumerate(element_dict['frame_labels'])]
+        sankey_figure.update_layout(margin=dict(b=120),
+                                    **generate_animation_layout(element_dict['frame_labels']))
 
+    return sankey_figure
@@ -0,0 +1,117 @@
+import asyncio
+import functools
+import logging
+import random
+import threading
+import time
+import weakref
+
+import requests
+from influxdb import DataFrameClient
+from influxdb.exceptions import InfluxDBServerError
+
+import generate_graph
+import metrics
+
+
+# Managed access to InfluxDB, shared by every thread of a worker:
+#   - at most POOL_SIZE keep-alive connections, further requests wait for a free one
+#   - QUERY_TIMEOUT seconds to connect and between two bytes of the answer
+#   - connection errors, timeouts and 5xx answers retried RETRIES times, with an exponential
+#     backoff of BACKOFF_SECONDS x 2^attempt and full jitter
+#   - at most MAX_IN_FLIGHT queries sent at once, streamed answers count until closed
+POOL_SIZE = 8
+QUERY_TIMEOUT = 30
+RETRIES = 3
+BACKOFF_SECONDS = 0.2
+MAX_IN_FLIGHT = 8
+
+logger = logging.getLogger(__name__)
+
+
+class ManagedInfluxClient(DataFrameClient):
+    def __init__(self, *args, pool_size=POOL_SIZE, timeout=QUERY_TIMEOUT, retries=RETRIES,
+                 backoff=BACKOFF_SECONDS, max_in_flight=MAX_IN_FLIGHT, **kwargs):
+        # The base client tries once, retries are made here with a backoff
+        super().__init__(*args, timeout=timeout, retries=1, pool_size=pool_size, **kwargs)
+        self.max_retries = retries
+        self.backoff = backoff
+        self.max_in_flight = max_in_flight
+        self._in_flight = threading.BoundedSemaphore(max_in_flight)
+
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                                                pool_block=True)
+        self._session.mount(self._scheme + '://', adapter)
+
+    def request(self, *args, **kwargs):
+        with metrics.span('influx_wait'):
+            self._in_flight.acquire()
+        try:
+            response = self.request_with_retries(*args, **kwargs)
+        except BaseException:
+            self._in_flight.release()
+            raise
+
+        if not kwargs.get('stream'):
+            self._in_flight.release()
+            return response
+
+        # A streamed answer keeps its connection until it is read, so it holds its slot
+        # until closed
+        response_close = response.close
+        released = threading.Event()
+
+        def close():
+            try:
+                response_close()
+            finally:
+                if not released.is_set():
+                    released.set()
+                    self._in_flight.release()
+
+        response.close = close
+        return response
+
+    def request_with_retries(self, *args, **kwargs):
+        attempt = 0
+        while True:
+            try:
+                return super().request(*args, **kwargs)
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout,
+                    InfluxDBServerError) as error:
+                if attempt >= self.max_retries:
+                    raise
+                delay = random.uniform(0, self.backoff * 2 ** attempt)
+                logger.warning('InfluxDB request failed (%s), retrying in %.2fs', error, delay)
+                time.sleep(delay)
+                attempt += 1
+
+
+class AsyncInfluxClient:
+    # asyncio front of a ManagedInfluxClient for async callbacks. The blocking requests run in
+    # an executor and keep the pool, timeouts and retries of the wrapped client; the asyncio
+    # semaphore keeps waiting queries from holding executor threads.
+    def __init__(self, client, executor=None):
+        self.client = client
+        self.executor = executor
+        self._semaphores = weakref.WeakKeyDictionary()
+
+    def get_semaphore(self):
+        loop = asyncio.get_running_loop()
+        semaphore = self._semaphores.get(loop)
+        if semaphore is None:
+            semaphore = self._semaphores[loop] = asyncio.Semaphore(self.client.max_in_flight)
+        return semaphore
+
+    async def run(self, function, *args, **kwargs):
+        async with self.get_semaphore():
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, functools.partial(function, *args, **kwargs))
+
+    async def query(self, query, bind_params=None, **kwargs):
+        return await self.run(self.client.query, query, bind_params=bind_params, **kwargs)
+
+    async def dates_query(self, metric_list, date_periods, query_cache=None, rollup_store=None,
+                          columns=None):
+        return await self.run(generate_graph.generate_dates_query, self.client, metric_list,
+                              date_periods, query_cache, rollup_store, columns)
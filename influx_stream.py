@@ -0,0 +1,93 @@
+import json
+
+import numpy as np
+import pandas as pd
+
+import utilities
+
+
+# Streaming read of `select sum(...)` results.
+#
+# InfluxDB answers a chunked query with one JSON document per line, each holding at most
+# CHUNK_SIZE points. Only one decoded chunk is alive at a time, and its values are copied into
+# the measurement x column float64 matrix before the next line is read. Peak memory is about
+#     one chunk (CHUNK_SIZE rows of the widest series) + 8 bytes x measurements x columns
+# When the column list is known upfront the matrix is allocated once before reading, otherwise
+# the non-null values of every series are kept until the end (never more than the matrix
+# itself) and the matrix is allocated once when the column union is known.
+CHUNK_SIZE = 10000
+
+
+class InfluxStreamError(Exception):
+    pass
+
+
+def stream_query_series(influx_client, query, bind_params, chunk_size=CHUNK_SIZE):
+    params = {'q': query,
+              'db': influx_client._database,
+              'params': json.dumps(bind_params),
+              'chunked': 'true',
+              'chunk_size': chunk_size}
+    response = influx_client.request(url='query', method='GET', params=params, stream=True,
+                                     headers={'Accept': 'application/json'})
+    try:
+        for line in response.iter_lines():
+            if not line:
+                continue
+            chunk = json.loads(line.decode('utf-8'))
+            if 'error' in chunk:
+                raise InfluxStreamError(chunk['error'])
+            for statement in chunk.get('results', []):
+                if 'error' in statement:
+                    raise InfluxStreamError(statement['error'])
+                for series in statement.get('series', []):
+                    yield series
+    finally:
+        response.close()
+
+
+def generate_series_sums(series, strip_prefix=True):
+    # Sum of every field over the rows of one series chunk, NaN where a field has no value
+    columns = series['columns'][1:]
+    if strip_prefix:
+        columns = [utilities.strip_sum_prefix(col_name) for col_name in columns]
+    values = np.array([row[1:] for row in series['values']], dtype=float)
+    sums = np.nansum(values, axis=0)
+    sums[np.isnan(values).all(axis=0)] = np.nan
+    return columns, sums
+
+
+def generate_sum_matrix(series_iterator, measurements_list, columns_list=None):
+    row_position = {measurement: i for i, measurement in enumerate(measurements_list)}
+
+    if columns_list is not None:
+        column_position = {col_name: j for j, col_name in enumerate(columns_list)}
+        matrix = np.full((len(measurements_list), len(columns_list)), np.nan)
+        for series in series_iterator:
+            i = row_position.get(series['name'])
+            if i is None:
+                continue
+            columns, sums = generate_series_sums(series, strip_prefix=False)
+            positions = np.array([column_position.get(col_name, -1) for col_name in columns])
+            known = (positions >= 0) & ~np.isnan(sums)
+            row = matrix[i, positions[known]]
+            matrix[i, positions[known]] = np.where(np.isnan(row), 0.0, row) + sums[known]
+        return pd.DataFrame(matrix, index=measurements_list, columns=columns_list)
+
+    column_position = {}
+    row_values = []
+    for series in series_iterator:
+        i = row_position.get(series['name'])
+        if i is None:
+            continue
+        columns, sums = generate_series_sums(series)
+        present = ~np.isnan(sums)
+        positions = np.array([column_position.setdefault(col_name, len(column_position))
+                              for col_name in columns], dtype=int)
+        row_values.append((i, positions[present], sums[present]))
+
+    matrix = np.full((len(measurements_list), len(column_position)), np.nan)
+    for i, positions, sums in row_values:
+        row = matrix[i, positions]
+        matrix[i, positions] = np.where(np.isnan(row), 0.0, row) + sums
+    return pd.DataFrame(matrix, index=measurements_list, columns=list(column_position))
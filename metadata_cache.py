@@ -0,0 +1,127 @@
+import argparse
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+
+# Compiled copies of the metadata CSVs, so that the workers start without parsing them:
+#   <directory>/<name>-<sha1 of the CSV>/columns.json   column names, blocks and text values
+#   <directory>/<name>-<sha1 of the CSV>/<block>.npy    columns x rows array of every block
+# Numeric columns are grouped by dtype into blocks stored as they are, text columns go to the
+# 'text' block as int32 codes into their distinct values, -1 where the value is missing.
+# Blocks are memory-mapped, so the workers of a host read them from the same page cache. An
+# edited CSV hashes to another copy, which is compiled by the first worker to need it, and
+# the stale copies are removed.
+TEXT_BLOCK = 'text'
+HASH_CHUNK_BYTES = 1 << 20
+
+
+def hash_file(path):
+    digest = hashlib.sha1()
+    with open(path, 'rb') as source_file:
+        for chunk in iter(lambda: source_file.read(HASH_CHUNK_BYTES), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def compile_table(csv_path, table_directory):
+    table_df = pd.read_csv(csv_path)
+    parent = os.path.dirname(table_directory)
+    os.makedirs(parent, exist_ok=True)
+    temp_directory = tempfile.mkdtemp(dir=parent, prefix='.compiling-')
+
+    try:
+        columns = []
+        blocks = {}
+        for col_name in table_df.columns:
+            column = table_df[col_name]
+            if column.dtype != object:
+                block = column.dtype.name
+                values = column.to_numpy()
+                columns.append({'name': col_name, 'block': block})
+            else:
+                block = TEXT_BLOCK
+                values, uniques = pd.factorize(column)
+                values = values.astype(np.int32)
+                columns.append({'name': col_name, 'block': block, 'values': list(uniques)})
+            columns[-1]['position'] = len(blocks.setdefault(block, []))
+            blocks[block].append(values)
+
+        for block, block_columns in blocks.items():
+            np.save(os.path.join(temp_directory, block + '.npy'), np.stack(block_columns))
+        with open(os.path.join(temp_directory, 'columns.json'), 'w') as columns_file:
+            json.dump({'source': os.path.basename(csv_path), 'rows': len(table_df),
+                       'columns': columns}, columns_file)
+
+        # Another worker may have compiled the same copy meanwhile, either one is fine
+        try:
+            os.rename(temp_directory, table_directory)
+        except OSError:
+            if not os.path.isdir(table_directory):
+                raise
+    finally:
+        if os.path.isdir(temp_directory):
+            shutil.rmtree(temp_directory, ignore_errors=True)
+
+
+def load_table(table_directory):
+    with open(os.path.join(table_directory, 'columns.json')) as columns_file:
+        meta = json.load(columns_file)
+
+    blocks = {}
+    table_columns = {}
+    for column in meta['columns']:
+        if column['block'] not in blocks:
+            blocks[column['block']] = np.load(
+                os.path.join(table_directory, column['block'] + '.npy'), mmap_mode='r')
+        array = blocks[column['block']][column['position']]
+        if column['block'] == TEXT_BLOCK:
+            # Code -1 picks the trailing NaN
+            array = np.array(column['values'] + [np.nan], dtype=object)[array]
+        table_columns[column['name']] = array
+    return pd.DataFrame(table_columns, columns=[column['name'] for column in meta['columns']],
+                        index=pd.RangeIndex(meta['rows']), copy=False)
+
+
+def table_directory_path(csv_path, directory):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    return os.path.join(directory, '{}-{}'.format(name, hash_file(csv_path)))
+
+
+def remove_stale_tables(csv_path, directory):
+    name = os.path.splitext(os.path.basename(csv_path))[0]
+    current = os.path.basename(table_directory_path(csv_path, directory))
+    for entry in os.scandir(directory):
+        if entry.is_dir() and entry.name.startswith(name + '-') and entry.name != current:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def read_metadata(csv_path, directory=None):
+    # Same DataFrame as pd.read_csv(csv_path), from the compiled copy when a directory is given
+    if directory is None:
+        return pd.read_csv(csv_path)
+
+    table_directory = table_directory_path(csv_path, directory)
+    if not os.path.isdir(table_directory):
+        compile_table(csv_path, table_directory)
+        remove_stale_tables(csv_path, directory)
+    return load_table(table_directory)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compile the metadata CSVs before starting '
+                                                 'the workers')
+    parser.add_argument('directory')
+    parser.add_argument('csv_paths', nargs='*',
+                        default=['./metadata/sensorMetadata.csv',
+                                 './metadata/BuildingMetadataAll.csv'])
+    arguments = parser.parse_args()
+
+    for path in arguments.csv_paths:
+        read_metadata(path, arguments.directory)
+        print('{} -> {}'.format(path, table_directory_path(path, arguments.directory)))
@@ -0,0 +1,110 @@
+import functools
+
+import numpy as np
+import pandas as pd
+
+import utilities
+
+
+def generate_row_index(values):
+    # Categorical codes of a metadata column and, for every value, the sorted positions of its
+    # rows. NaN values get the code -1 and are left out of the positions.
+    codes, uniques = pd.factorize(values)
+    order = np.argsort(codes, kind='stable')
+    counts = np.bincount(codes[codes >= 0], minlength=len(uniques))
+    first_valid = len(codes) - counts.sum()
+    row_groups = np.split(order[first_valid:], np.cumsum(counts)[:-1])
+    return codes, uniques, dict(zip(uniques, row_groups))
+
+
+class MetadataIndex:
+    # Lookups over the sensor and building metadata, built once when the app starts so the
+    # callbacks never have to scan the DataFrames again
+    def __init__(self, sensor_metadata, building_metadata, grouping_columns):
+        self.sensor_metadata = sensor_metadata
+        self.building_metadata = building_metadata
+        self.category_columns = list(sensor_metadata.filter(regex='category', axis=1).columns)
+        self.grouping_columns = list(grouping_columns)
+
+        self.sensor_codes = {}
+        self.sensor_rows = {}
+        for column in ['building'] + self.category_columns:
+            codes, uniques, rows = generate_row_index(sensor_metadata[column])
+            self.sensor_codes[column] = (codes, uniques)
+            self.sensor_rows[column] = rows
+
+        self.group_rows = {}
+        _, _, self.building_rows = generate_row_index(building_metadata['building'])
+        for grouping in self.grouping_columns:
+            _, _, self.group_rows[grouping] = generate_row_index(building_metadata[grouping])
+
+        sensor_ids = sensor_metadata['sensor_short_id'].to_numpy()
+        self.building_sensors = {building: sensor_ids[rows]
+                                 for building, rows in self.sensor_rows['building'].items()}
+
+    def _select_rows(self, rows_dict, selection):
+        rows = [rows_dict[value] for value in selection if value in rows_dict]
+        if len(rows) == 0:
+            return np.empty(0, dtype=int)
+        return np.sort(np.concatenate(rows))
+
+    def category_list(self, category_type):
+        return self.sensor_codes[category_type][1]
+
+    def category_options(self, category_type):
+        return self._category_options(category_type)
+
+    @functools.lru_cache(maxsize=None)
+    def _category_options(self, category_type):
+        category_list = self.category_list(category_type)
+        if len(category_list) > 0:
+            return utilities.generate_option_array_from_list(np.sort(category_list))
+        return [{'label': 'Not Found', 'value': 'nan'}]
+
+    def building_options(self, category_type, category_selection):
+        return self._building_options(category_type, frozenset(category_selection or ()))
+
+    @functools.lru_cache(maxsize=1024)
+    def _building_options(self, category_type, category_selection):
+        building_codes, building_list = self.sensor_codes['building']
+        if category_selection:
+            rows = self._select_rows(self.sensor_rows[category_type], category_selection)
+            codes = np.unique(building_codes[rows])
+            building_list = building_list[codes[codes >= 0]]
+        return utilities.generate_option_array_from_list(np.sort(np.asarray(building_list)))
+
+    def group_options(self, grouping):
+        return self._group_options(grouping)
+
+    @functools.lru_cache(maxsize=None)
+    def _group_options(self, grouping):
+        return utilities.generate_option_array_from_list(self.building_metadata[grouping].unique())
+
+    def building_filter_options(self, grouping, group_selection):
+        return self._building_filter_options(grouping, frozenset(group_selection or ()))
+
+    @functools.lru_cache(maxsize=1024)
+    def _building_filter_options(self, grouping, group_selection):
+        building_names = self.building_metadata['building'].to_numpy()
+        if group_selection:
+            building_names = building_names[self._select_rows(self.group_rows[grouping],
+                                                              group_selection)]
+        return utilities.generate_option_array_from_list(building_names)
+
+    def filter_sensor_metadata(self, category_type, category_selection, building_selection):
+        rows = self._select_rows(self.sensor_rows['building'], building_selection)
+        if category_selection:
+            rows = np.intersect1d(rows, self._select_rows(self.sensor_rows[category_type],
+                                                          category_selection))
+        return self.sensor_metadata.iloc[rows]
+
+    def filter_building_metadata(self, grouping, group_selection, building_filter):
+        if not group_selection and not building_filter:
+            return self.building_metadata
+
+        rows = np.arange(len(self.building_metadata))
+        if group_selection:
+            rows = self._select_rows(self.group_rows[grouping], group_selection)
+        if building_filter:
+            rows = np.intersect1d(rows, self._select_rows(self.building_rows, building_filter))
+        return self.building_metadata.iloc[rows]
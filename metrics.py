@@ -0,0 +1,126 @@
+import contextlib
+import contextvars
+import functools
+import logging
+import threading
+import time
+
+
+# Latency histograms per pipeline stage and view, exported in the Prometheus text format.
+# Every gunicorn worker keeps its own histograms; the scraper sums them per instance.
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+SLOW_REQUEST_SECONDS = 2.0
+
+logger = logging.getLogger(__name__)
+
+current_view = contextvars.ContextVar('current_view', default='none')
+current_spans = contextvars.ContextVar('current_spans', default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, upper_bound in enumerate(self.buckets):
+            if value <= upper_bound:
+                self.counts[i] += 1
+                break
+        else:
+            self.counts[-1] += 1
+        self.sum += value
+        self.count += 1
+
+
+histograms = {}
+histograms_lock = threading.Lock()
+
+
+def observe(stage, view, seconds):
+    with histograms_lock:
+        histogram = histograms.get((stage, view))
+        if histogram is None:
+            histogram = histograms[(stage, view)] = Histogram()
+        histogram.observe(seconds)
+
+
+def record(stage, seconds):
+    observe(stage, current_view.get(), seconds)
+    spans = current_spans.get()
+    if spans is not None:
+        spans.append((stage, seconds))
+
+
+@contextlib.contextmanager
+def span(stage):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        record(stage, time.perf_counter() - start)
+
+
+def timed(stage):
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+@contextlib.contextmanager
+def request_span(view, inputs=None):
+    # Labels every span of the request with its view and logs the breakdown of slow requests
+    view_token = current_view.set(view)
+    spans_token = current_spans.set([])
+    start = time.perf_counter()
+    try:
+        with span('request'):
+            yield
+    finally:
+        elapsed = time.perf_counter() - start
+        spans = current_spans.get()
+        current_spans.reset(spans_token)
+        current_view.reset(view_token)
+        if elapsed > SLOW_REQUEST_SECONDS:
+            breakdown = ', '.join('{}={:.3f}s'.format(stage, seconds) for stage, seconds in spans)
+            logger.warning('Slow %s request took %.3fs (%s) inputs=%s',
+                           view, elapsed, breakdown, inputs)
+
+
+def format_labels(labels):
+    return ','.join('{}="{}"'.format(name, str(value).replace('\\', '\\\\').replace('"', '\\"'))
+                    for name, value in labels)
+
+
+def render_histograms(name='sankey_stage_duration_seconds'):
+    lines = ['# HELP {} Duration of the Sankey pipeline stages.'.format(name),
+             '# TYPE {} histogram'.format(name)]
+    with histograms_lock:
+        for (stage, view), histogram in sorted(histograms.items()):
+            labels = [('stage', stage), ('view', view)]
+            cumulative = 0
+            for upper_bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append('{}_bucket{{{}}} {}'.format(
+                    name, format_labels(labels + [('le', upper_bound)]), cumulative))
+            lines.append('{}_bucket{{{}}} {}'.format(
+                name, format_labels(labels + [('le', '+Inf')]), histogram.count))
+            lines.append('{}_sum{{{}}} {}'.format(name, format_labels(labels), histogram.sum))
+            lines.append('{}_count{{{}}} {}'.format(name, format_labels(labels), histogram.count))
+    return lines
+
+
+def render_counters(name, help_text, values, metric_type='counter'):
+    # values maps a tuple of (label, value) pairs to the counter value
+    lines = ['# HELP {} {}'.format(name, help_text),
+             '# TYPE {} {}'.format(name, metric_type)]
+    for labels, value in values.items():
+        label_string = '{{{}}}'.format(format_labels(labels)) if labels else ''
+        lines.append('{}{} {}'.format(name, label_string, value))
+    return lines
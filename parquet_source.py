@@ -0,0 +1,235 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.ipc as ipc
+import pyarrow.parquet as pq
+
+import rollup
+import utilities
+
+
+# Offline data source answering the range sums from the raw series stored on disk, as
+#   <directory>/<building>/<YYYY-MM>.arrow
+# with the columns time (int64 ns, UTC), measurement and field (dictionary strings) and value
+# (float64), sorted on time. A building partition holds the building measurement, its
+# simulation_ twin and the building field of every metric measurement (Elec, Gas, HotWater).
+# Arrow files are memory-mapped and sliced on time without a copy; <YYYY-MM>.parquet files are
+# read as well. Requires pyarrow, which the influx deployment does not need.
+METRIC_LIST = ['Elec', 'Gas', 'HotWater']
+SIMULATION_PREFIX = 'simulation_'
+
+
+def read_partition(path):
+    if path.endswith('.arrow'):
+        table = ipc.open_file(pa.memory_map(path)).read_all()
+    else:
+        table = pq.read_table(path, memory_map=True, read_dictionary=['measurement', 'field'])
+    table = table.unify_dictionaries().combine_chunks()
+
+    # An empty table has no chunk to read
+    if table.num_rows == 0:
+        return {'time': np.empty(0, dtype=np.int64), 'value': np.empty(0),
+                'measurement': np.empty(0, dtype=int), 'measurement_names': [],
+                'field': np.empty(0, dtype=int), 'field_names': []}
+
+    partition = {'time': table.column('time').chunk(0).to_numpy(),
+                 'value': table.column('value').chunk(0).to_numpy()}
+    for name in ['measurement', 'field']:
+        column = table.column(name).chunk(0)
+        partition[name] = column.indices.to_numpy()
+        partition[name + '_names'] = column.dictionary.to_pylist()
+    return partition
+
+
+class ParquetSource:
+    def __init__(self, directory, metric_list=METRIC_LIST):
+        self.directory = directory
+        self.metric_list = set(metric_list)
+        self._loaded = {}
+
+    def building_list(self):
+        return sorted(entry.name for entry in os.scandir(self.directory) if entry.is_dir())
+
+    def partition_buildings(self, measurements_list, columns=None):
+        # Metric measurements have one field per building, the others are buildings
+        buildings = set()
+        for measurement in measurements_list:
+            if measurement in self.metric_list:
+                buildings.update(self.building_list() if columns is None else columns)
+            elif measurement.startswith(SIMULATION_PREFIX):
+                buildings.add(measurement[len(SIMULATION_PREFIX):])
+            else:
+                buildings.add(measurement)
+        return sorted(buildings)
+
+    def partition_paths(self, building, start, end):
+        paths = []
+        for month in pd.period_range(start.to_period('M'), end.to_period('M'), freq='M'):
+            base = os.path.join(self.directory, building, month.strftime('%Y-%m'))
+            for path in [base + '.arrow', base + '.parquet']:
+                if os.path.exists(path):
+                    paths.append(path)
+                    break
+        return paths
+
+    def load(self, path):
+        modified = os.path.getmtime(path)
+        cached = self._loaded.get(path)
+        if cached is None or cached[0] != modified:
+            cached = self._loaded[path] = (modified, read_partition(path))
+        return cached[1]
+
+    def scan(self, start, end, measurements_list, end_inclusive=True, columns=None):
+        # Values of the measurements in the range, as the arrays of their row in
+        # measurements_list, column in the returned column list, time and value
+        row_position = {measurement: i for i, measurement in enumerate(measurements_list)}
+        if columns is None:
+            column_position = {}
+        else:
+            column_position = {col_name: j for j, col_name in enumerate(columns)}
+
+        blocks = [(np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0, dtype=np.int64),
+                   np.empty(0))]
+        for building in self.partition_buildings(measurements_list, columns):
+            for path in self.partition_paths(building, start, end):
+                partition = self.load(path)
+                first = np.searchsorted(partition['time'], start.value, side='left')
+                last = np.searchsorted(partition['time'], end.value,
+                                       side='right' if end_inclusive else 'left')
+
+                measurement_rows = np.array([row_position.get(name, -1) for name
+                                             in partition['measurement_names']], dtype=int)
+                rows = measurement_rows[partition['measurement'][first:last]]
+                selected = rows >= 0
+                field_codes = partition['field'][first:last][selected]
+
+                # Without a column list, only the fields of the selected measurements count
+                field_names = partition['field_names']
+                if columns is None:
+                    field_columns = np.full(len(field_names), -1, dtype=int)
+                    for code in np.unique(field_codes):
+                        field_columns[code] = column_position.setdefault(field_names[code],
+                                                                         len(column_position))
+                else:
+                    field_columns = np.array([column_position.get(name, -1) for name
+                                              in field_names], dtype=int)
+
+                cols = field_columns[field_codes]
+                times = partition['time'][first:last][selected]
+                values = partition['value'][first:last][selected]
+                known = (cols >= 0) & ~np.isnan(values)
+                blocks.append((rows[selected][known], cols[known], times[known], values[known]))
+
+        rows, cols, times, values = [np.concatenate(arrays) for arrays in zip(*blocks)]
+        return rows, cols, times, values, list(column_position)
+
+    def range_sums(self, start_date, end_date, measurements_list, end_inclusive=True,
+                   columns=None):
+        # Same frame as query_range_sums: one row per measurement, one column per field and
+        # NaN where a field has no value in the range
+        rows, cols, _, values, columns = self.scan(rollup.to_utc_timestamp(start_date),
+                                                   rollup.to_utc_timestamp(end_date),
+                                                   measurements_list, end_inclusive, columns)
+        sums = generate_cell_sums(rows * len(columns) + cols, values,
+                                  len(measurements_list) * len(columns))
+        return pd.DataFrame(sums.reshape(len(measurements_list), len(columns)),
+                            index=measurements_list, columns=columns)
+
+    def daily_sums(self, start_date, end_date, measurements_list, columns=None):
+        # Same arrays as generate_graph.query_daily_sums, end_date at midnight included
+        start = rollup.to_utc_timestamp(start_date)
+        end = rollup.to_utc_timestamp(end_date)
+        days = pd.date_range(rollup.floor_day(start), rollup.floor_day(end), freq='D')
+        rows, cols, times, values, columns = self.scan(start, end, measurements_list,
+                                                       True, columns)
+        day_positions = (times - days[0].value) // rollup.ONE_DAY.value
+        shape = (len(days), len(measurements_list), len(columns))
+        sums = generate_cell_sums((day_positions * shape[1] + rows) * shape[2] + cols, values,
+                                  int(np.prod(shape)))
+        return days, sums.reshape(shape), columns
+
+
+def generate_cell_sums(cells, values, size):
+    # Sum of the values of every cell, NaN for the cells without any value
+    sums = np.bincount(cells, weights=values, minlength=size).astype(float)
+    sums[np.bincount(cells, minlength=size) == 0] = np.nan
+    return sums
+
+
+def write_partition(directory, building, month, series_df):
+    # series_df has the columns time (UTC), measurement, field and value
+    series_df = series_df.sort_values('time', kind='stable')
+    table = pa.table({
+        'time': pa.array(pd.to_datetime(series_df['time']).values.astype('int64')),
+        'measurement': pa.array(series_df['measurement'].astype(str),
+                                pa.string()).dictionary_encode(),
+        'field': pa.array(series_df['field'].astype(str), pa.string()).dictionary_encode(),
+        'value': pa.array(series_df['value'].to_numpy(dtype=float))})
+
+    os.makedirs(os.path.join(directory, building), exist_ok=True)
+    path = os.path.join(directory, building, '{}.arrow'.format(month.strftime('%Y-%m')))
+    temp_path = path + '.tmp'
+    with pa.OSFile(temp_path, 'wb') as sink:
+        with ipc.new_file(sink, table.schema) as writer:
+            writer.write_table(table)
+    os.replace(temp_path, path)
+
+
+def query_month_series(influx_client, measurement, month, fields=None):
+    where_parameters = {'t0': rollup.format_influx_date(month.start_time),
+                        't1': rollup.format_influx_date(month.end_time.ceil('D'))}
+    if fields is None:
+        select_string = '*'
+    else:
+        select_string = ', '.join(utilities.quote_identifier(field) for field in fields)
+    query_influx = 'select {} from {} where time>=$t0 and time<$t1'. \
+        format(select_string, utilities.quote_identifier(measurement))
+    query_result = influx_client.query(query_influx, bind_params=where_parameters)
+
+    if measurement not in query_result:
+        return pd.DataFrame(columns=['time', 'measurement', 'field', 'value'])
+    series_df = query_result[measurement]
+    if series_df.index.tz is not None:
+        series_df.index = series_df.index.tz_convert('UTC').tz_localize(None)
+    series_df = series_df.rename_axis(index='time', columns='field').stack().rename('value')
+    series_df = series_df.reset_index()
+    series_df['measurement'] = measurement
+    return series_df
+
+
+def export_from_influx(influx_client, directory, building_list, start_month, end_month,
+                       metric_list=METRIC_LIST):
+    for month in pd.period_range(start_month, end_month, freq='M'):
+        for building in building_list:
+            series_frames = [query_month_series(influx_client, metric, month, [building])
+                             for metric in metric_list]
+            series_frames.append(query_month_series(influx_client, building, month))
+            series_frames.append(query_month_series(influx_client,
+                                                    SIMULATION_PREFIX + building, month))
+            series_df = pd.concat(series_frames)
+            # Months without data have no partition
+            if len(series_df) > 0:
+                write_partition(directory, building, month, series_df)
+
+
+if __name__ == '__main__':
+    from influx_pool import ManagedInfluxClient
+
+    parser = argparse.ArgumentParser(description='Export the InfluxDB series to Arrow files '
+                                                 'for the offline data source')
+    parser.add_argument('directory')
+    parser.add_argument('--start', default='2015-01', help='first month to export')
+    parser.add_argument('--end', default='2020-11', help='last month to export')
+    parser.add_argument('--host', default='206.12.88.106')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='sankey-generator')
+    arguments = parser.parse_args()
+
+    client = ManagedInfluxClient(host=arguments.host, port=arguments.port,
+                                 username='root', password='root',
+                                 database=arguments.database)
+    buildings = pd.read_csv('./metadata/sensorMetadata.csv')['building'].unique()
+    export_from_influx(client, arguments.directory, buildings, arguments.start, arguments.end)
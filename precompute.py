@@ -0,0 +1,167 @@
+import argparse
+import fcntl
+import logging
+import os
+import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime as dt
+
+import pandas as pd
+
+import utilities
+
+
+# Warms the query and figure caches for the date windows most requests ask for: the default
+# window and the last calendar months, each alone and with the 30 day comparison period that
+# enable_date_comparison proposes, for every building grouping. Runs off-peak only, with at most
+# max_workers warm-ups at a time (each one sends up to two period queries to InfluxDB).
+#
+# In the app (SANKEY_PRECOMPUTE=1) the scheduler runs in every gunicorn worker. With
+# SANKEY_CACHE_DIR set, only the worker holding <SANKEY_CACHE_DIR>/precompute.lock warms, its
+# figure cache and the query cache on disk that the other workers read. Without it every
+# worker warms its own caches, max_workers warm-ups per worker. As a separate process
+#   SANKEY_CACHE_DIR=... python precompute.py --hours 0-6 --workers 2
+# it only warms the query cache shared on disk and takes the same lock, so it requires
+# SANKEY_CACHE_DIR.
+OFF_PEAK_HOURS = (0, 6)
+MAX_WORKERS = 2
+N_MONTHS = 12
+INTERVAL_SECONDS = 3600
+LOCK_NAME = 'precompute.lock'
+
+logger = logging.getLogger(__name__)
+
+
+def parse_hours(hours):
+    # '22-6' -> (22, 6), the end hour is excluded and the range may wrap around midnight
+    start_hour, end_hour = hours.split('-')
+    return int(start_hour), int(end_hour)
+
+
+def is_off_peak(hour, off_peak_hours):
+    start_hour, end_hour = off_peak_hours
+    if start_hour <= end_hour:
+        return start_hour <= hour < end_hour
+    return hour >= start_hour or hour < end_hour
+
+
+def generate_month_windows(last_date, n_months):
+    # Calendar months before the one containing last_date, most recent first
+    months = pd.period_range(end=pd.Period(last_date, 'M') - 1, periods=n_months, freq='M')
+    return [(month.start_time.strftime('%Y-%m-%d'), month.end_time.strftime('%Y-%m-%d'))
+            for month in reversed(months)]
+
+
+def generate_popular_date_periods(windows):
+    # The comparison picker holds the main dates while the comparison is off
+    date_periods_list = []
+    for start_date, end_date in windows:
+        for date_periods in [[(start_date, end_date), (start_date, end_date)],
+                             [(start_date, end_date),
+                              utilities.generate_comparison_dates(start_date, end_date)]]:
+            if date_periods not in date_periods_list:
+                date_periods_list.append(date_periods)
+    return date_periods_list
+
+
+def generate_jobs(grouping_list, date_periods_list):
+    # Most popular windows first, so that a short off-peak slot covers them
+    return [(grouping_type, date_periods) for date_periods in date_periods_list
+            for grouping_type in grouping_list]
+
+
+class PrecomputeScheduler:
+    def __init__(self, warm_function, jobs, max_workers=MAX_WORKERS,
+                 off_peak_hours=OFF_PEAK_HOURS, interval=INTERVAL_SECONDS, lock_path=None):
+        self.warm_function = warm_function
+        self.jobs = jobs
+        self.max_workers = max_workers
+        self.off_peak_hours = off_peak_hours
+        self.interval = interval
+        self.lock_path = lock_path
+        self._lock_file = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def acquire_lock(self):
+        # One process warms per lock file, it holds the lock until it exits. The others try
+        # again at every interval, so that one of them takes over when it stops.
+        if self.lock_path is None or self._lock_file is not None:
+            return True
+        lock_file = open(self.lock_path, 'a')
+        try:
+            fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            lock_file.close()
+            return False
+        self._lock_file = lock_file
+        return True
+
+    def is_off_peak(self):
+        return is_off_peak(dt.now().hour, self.off_peak_hours)
+
+    def run_job(self, job):
+        # Jobs still queued when the off-peak slot ends are left for the next one
+        if self._stop.is_set() or not self.is_off_peak():
+            return False
+        try:
+            self.warm_function(*job)
+        except Exception:
+            logger.exception('Precomputing %s failed', job)
+            return False
+        return True
+
+    def run_once(self):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            warmed = sum(executor.map(self.run_job, self.jobs))
+        logger.info('Precomputed %d of %d Sankey outputs', warmed, len(self.jobs))
+        return warmed
+
+    def run_forever(self):
+        while not self._stop.is_set():
+            if self.is_off_peak() and self.acquire_lock():
+                self.run_once()
+            self._stop.wait(self.interval)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.run_forever, name='sankey-precompute',
+                                        daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Warm the Sankey caches for popular windows')
+    parser.add_argument('--workers', type=int, default=MAX_WORKERS,
+                        help='concurrent warm-ups, each sends up to two InfluxDB queries')
+    parser.add_argument('--hours', default='{}-{}'.format(*OFF_PEAK_HOURS),
+                        help='off-peak hours, e.g. 22-6')
+    parser.add_argument('--months', type=int, default=N_MONTHS)
+    parser.add_argument('--once', action='store_true', help='warm once now and exit')
+    arguments = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+
+    # The figure cache of this process is not served, only the query cache on disk is
+    if not os.environ.get('SANKEY_CACHE_DIR'):
+        parser.error('SANKEY_CACHE_DIR must be set to the query cache directory of the app')
+
+    # Importing app must not start its own scheduler or render pool
+    os.environ['SANKEY_PRECOMPUTE'] = '0'
+    os.environ['SANKEY_RENDER_WORKERS'] = '0'
+    import app
+
+    scheduler = PrecomputeScheduler(app.warm_sankey_output,
+                                    app.generate_precompute_jobs(arguments.months),
+                                    arguments.workers, parse_hours(arguments.hours),
+                                    lock_path=os.path.join(os.environ['SANKEY_CACHE_DIR'],
+                                                           LOCK_NAME))
+    if arguments.once:
+        if not scheduler.acquire_lock():
+            sys.exit('Another process is precomputing, {} is locked'.format(scheduler.lock_path))
+        scheduler.off_peak_hours = (0, 24)
+        scheduler.run_once()
+    else:
+        scheduler.run_forever()
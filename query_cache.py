@@ -0,0 +1,172 @@
+import hashlib
+import os
+import pickle
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import pandas as pd
+
+
+# Ranges ending before now - CLOSED_RANGE_DELAY are considered final and never expire
+CLOSED_RANGE_DELAY = pd.Timedelta(days=1)
+
+
+def normalize_date(date):
+    # '2020-10-01', '2020-10-01T00:00:00' and '2020-10-01 00:00:00+00:00' share one key
+    timestamp = pd.Timestamp(date)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp.isoformat()
+
+
+def generate_cache_key(measurements_list, start_date, end_date, *extra):
+    return (tuple(measurements_list),
+            normalize_date(start_date),
+            normalize_date(end_date)) + tuple(extra)
+
+
+def is_closed_range(end_date, now=None):
+    if now is None:
+        now = pd.Timestamp.utcnow().tz_localize(None)
+    return pd.Timestamp(normalize_date(end_date)) < now - CLOSED_RANGE_DELAY
+
+
+class MemoryBackend:
+    # In-process LRU, one per gunicorn worker
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+            return entry
+
+    def set(self, key, entry):
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class DiskBackend:
+    # Pickle files in a shared directory so every worker on the host reuses the same results.
+    # Recency is tracked with the file mtime, which is refreshed on every hit.
+    def __init__(self, directory, max_entries=1024):
+        self.directory = directory
+        self.max_entries = max_entries
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + '.pkl')
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as cache_file:
+                stored_key, entry = pickle.load(cache_file)
+            os.utime(path)
+        except (OSError, EOFError, pickle.UnpicklingError):
+            return None
+        if stored_key != key:
+            return None
+        return entry
+
+    def set(self, key, entry):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        with os.fdopen(file_descriptor, 'wb') as cache_file:
+            pickle.dump((key, entry), cache_file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, self._path(key))
+        self._evict()
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def clear(self):
+        for path in self._cache_files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _cache_files(self):
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                if name.endswith('.pkl')]
+
+    def _evict(self):
+        cache_files = self._cache_files()
+        if len(cache_files) <= self.max_entries:
+            return
+        by_age = []
+        for path in cache_files:
+            try:
+                by_age.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+        by_age.sort()
+        for _, path in by_age[:len(by_age) - self.max_entries]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def __len__(self):
+        return len(self._cache_files())
+
+
+class QueryCache:
+    def __init__(self, backend=None, ttl=300):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        entry = self.backend.get(key)
+        if entry is None:
+            return None
+        expires_at, value = entry
+        if expires_at is not None and expires_at < time.time():
+            self.backend.delete(key)
+            return None
+        return value
+
+    def set(self, key, value, closed=False):
+        expires_at = None if closed else time.time() + self.ttl
+        self.backend.set(key, (expires_at, value))
+
+    def get_or_query(self, measurements_list, start_date, end_date, query_function, *extra):
+        key = generate_cache_key(measurements_list, start_date, end_date, *extra)
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value
+
+        self.misses += 1
+        value = query_function()
+        self.set(key, value, closed=is_closed_range(end_date))
+        return value
+
+    def clear(self):
+        self.backend.clear()
@@ -0,0 +1,97 @@
+import logging
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+import metrics
+
+
+# Optional process pool for the CPU-heavy part of a render (element building and figure
+# serialization), so that a large diagram does not hold the GIL of the worker that also serves
+# the small dropdown callbacks. The workers are forked when the pool starts, before the process
+# starts any thread, and share its metadata copy-on-write. Functions sent to the pool must be
+# module-level to be pickled by reference. Not for gunicorn --preload, whose workers would
+# inherit the pool of the master. The workers keep their own caches: worker_stats, a
+# module-level function as well, reports their counters back with every render.
+logger = logging.getLogger(__name__)
+
+
+def run_task(function, args, worker_stats=None):
+    # Runs in a pool worker: the result comes back with the stage timings, the busy time and
+    # the counters of the worker
+    spans_token = metrics.current_spans.set([])
+    start = time.perf_counter()
+    try:
+        result = function(*args)
+        busy_seconds = time.perf_counter() - start
+        stats = None if worker_stats is None else worker_stats()
+        return result, metrics.current_spans.get(), busy_seconds, (os.getpid(), stats)
+    finally:
+        metrics.current_spans.reset(spans_token)
+
+
+class RenderPool:
+    def __init__(self, max_workers, worker_stats=None):
+        self.max_workers = max_workers
+        self.worker_stats = worker_stats
+        self.in_flight = 0
+        self.completed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._worker_stats = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+    def start(self):
+        self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                             mp_context=multiprocessing.get_context('fork'))
+        # Fork every worker now, while this process still has a single thread
+        self._executor.submit(os.getpid).result()
+
+    def run(self, function, *args):
+        # Runs function(*args) in the pool, or inline when the pool is not started
+        if self._executor is None:
+            return function(*args)
+
+        with self._lock:
+            self.in_flight += 1
+        try:
+            with metrics.span('render_pool'):
+                result, spans, busy_seconds, (pid, stats) = self._executor.submit(
+                    run_task, function, args, self.worker_stats).result()
+        except BrokenProcessPool:
+            # A worker died, the pool cannot be forked again safely from this threaded process
+            logger.exception('Render pool broken, rendering in the request threads from now on')
+            self._executor = None
+            with self._lock:
+                self.failed += 1
+            return function(*args)
+        finally:
+            with self._lock:
+                self.in_flight -= 1
+
+        with self._lock:
+            self.completed += 1
+            self.busy_seconds += busy_seconds
+            if stats is not None:
+                self._worker_stats[pid] = stats
+        for stage, seconds in spans:
+            metrics.record(stage, seconds)
+        return result
+
+    def collected_worker_stats(self):
+        # Last counters reported by every worker, by process id
+        with self._lock:
+            return dict(self._worker_stats)
+
+    def stats(self):
+        with self._lock:
+            return {'workers': self.max_workers if self._executor is not None else 0,
+                    'in_flight': self.in_flight,
+                    'queue_depth': max(self.in_flight - self.max_workers, 0),
+                    'completed': self.completed,
+                    'failed': self.failed,
+                    'busy_seconds': self.busy_seconds}
@@ -0,0 +1,92 @@
+import contextlib
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import CancelledError
+
+
+# Requests of the main callback, per browser session (the id of the 'session-id' store):
+# - a newer request supersedes the older ones of its session, those still waiting are dropped
+#   and those running stop at their next checkpoint
+# - at most max_in_flight requests of a session run at once, the newest waiting one runs next
+# - with a debounce, a request first waits that long and is dropped if a newer one came
+#   meanwhile, so that only the last state of a burst of changes is computed
+# Dropped requests raise Superseded. Requests without a session id are never limited.
+current_request = contextvars.ContextVar('current_request', default=None)
+
+
+class Superseded(CancelledError):
+    pass
+
+
+class RequestLimiter:
+    def __init__(self, max_in_flight=1, debounce=0.0, max_sessions=4096):
+        self.max_in_flight = max_in_flight
+        self.debounce = debounce
+        self.max_sessions = max_sessions
+        self.admitted = 0
+        self.dropped_waiting = 0
+        self.dropped_running = 0
+        self._sessions = OrderedDict()
+        self._condition = threading.Condition()
+
+    @contextlib.contextmanager
+    def request(self, session_id, debounce=None):
+        if session_id is None:
+            yield
+            return
+
+        debounce = self.debounce if debounce is None else debounce
+        with self._condition:
+            session = self._sessions.get(session_id)
+            if session is None:
+                session = {'latest': 0, 'running': 0}
+                self._sessions[session_id] = session
+                while len(self._sessions) > self.max_sessions:
+                    self._sessions.popitem(last=False)
+            self._sessions.move_to_end(session_id)
+            session['latest'] += 1
+            ticket = (session, session['latest'])
+            # The older requests of the session waiting for their turn give up
+            self._condition.notify_all()
+
+            deadline = time.monotonic() + debounce
+            while True:
+                if session['latest'] != ticket[1]:
+                    self.dropped_waiting += 1
+                    raise Superseded()
+                remaining = deadline - time.monotonic()
+                if remaining > 0:
+                    self._condition.wait(remaining)
+                elif session['running'] < self.max_in_flight:
+                    break
+                else:
+                    self._condition.wait()
+            session['running'] += 1
+            self.admitted += 1
+
+        token = current_request.set(ticket)
+        try:
+            yield
+        finally:
+            current_request.reset(token)
+            with self._condition:
+                session['running'] -= 1
+                self._condition.notify_all()
+
+    def check(self):
+        # Checkpoint between the stages of a request, raises once a newer request came
+        ticket = current_request.get()
+        if ticket is not None and ticket[0]['latest'] != ticket[1]:
+            with self._condition:
+                self.dropped_running += 1
+            raise Superseded()
+
+    def stats(self):
+        with self._condition:
+            return {'admitted': self.admitted,
+                    'dropped_waiting': self.dropped_waiting,
+                    'dropped_running': self.dropped_running,
+                    'sessions': len(self._sessions),
+                    'running': sum(session['running'] for session in self._sessions.values())}
@@ -0,0 +1,222 @@
+import argparse
+import json
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+import utilities
+
+
+# Each measurement is stored as a prefix-sum matrix of daily sums:
+#   <measurement>.npy   (n_days + 1) x n_columns float64, row 0 is zeros and row i holds the
+#                       sum of every day in [first_day, first_day + i days)
+#   <measurement>.json  column names, first_day and the watermark (first day not yet stored)
+# so the sum over any block of whole days is the difference of two rows.
+ONE_DAY = pd.Timedelta(days=1)
+REFRESH_WINDOW_DAYS = 31
+
+
+def to_utc_timestamp(date):
+    timestamp = pd.Timestamp(date)
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.tz_convert('UTC').tz_localize(None)
+    return timestamp
+
+
+def floor_day(date):
+    return to_utc_timestamp(date).floor('D')
+
+
+def format_influx_date(timestamp):
+    return pd.Timestamp(timestamp).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class RollupStore:
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self._loaded = {}
+
+    def _paths(self, measurement):
+        base = os.path.join(self.directory, measurement)
+        return base + '.json', base + '.npy'
+
+    def load(self, measurement):
+        meta_path, array_path = self._paths(measurement)
+        try:
+            modified = os.path.getmtime(meta_path)
+        except OSError:
+            return None, None
+
+        cached = self._loaded.get(measurement)
+        if cached is not None and cached[0] == modified:
+            return cached[1], cached[2]
+
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        meta['first_day'] = pd.Timestamp(meta['first_day'])
+        meta['watermark'] = pd.Timestamp(meta['watermark'])
+        cumulative = np.load(array_path, mmap_mode='r')
+        self._loaded[measurement] = (modified, meta, cumulative)
+        return meta, cumulative
+
+    def watermark(self, measurement):
+        meta, _ = self.load(measurement)
+        return None if meta is None else meta['watermark']
+
+    def covered_days(self, measurements_list):
+        first_days = []
+        watermarks = []
+        for measurement in measurements_list:
+            meta, _ = self.load(measurement)
+            if meta is None:
+                return None
+            first_days.append(meta['first_day'])
+            watermarks.append(meta['watermark'])
+        return max(first_days), min(watermarks)
+
+    def plan_range(self, measurements_list, start_date, end_date):
+        # Split [start_date, end_date] into whole stored days plus the edges that still need
+        # to be read from influx, as (start, end, end_inclusive) tuples
+        covered = self.covered_days(measurements_list)
+        if covered is None:
+            return None
+
+        start = to_utc_timestamp(start_date)
+        end = to_utc_timestamp(end_date)
+
+        first_day = max(start.ceil('D'), covered[0])
+        end_day = min(end.floor('D'), covered[1])
+        if first_day >= end_day:
+            return None
+
+        edges = []
+        if start < first_day:
+            edges.append((format_influx_date(start), format_influx_date(first_day), False))
+        edges.append((format_influx_date(end_day), format_influx_date(end), True))
+        return first_day, end_day, edges
+
+    def range_sum(self, measurements_list, first_day, end_day):
+        rows = []
+        for measurement in measurements_list:
+            meta, cumulative = self.load(measurement)
+            start_index = (first_day - meta['first_day']).days
+            end_index = (end_day - meta['first_day']).days
+            values = np.asarray(cumulative[end_index]) - np.asarray(cumulative[start_index])
+            rows.append(pd.Series(values, index=meta['columns'], name=measurement))
+        return pd.concat(rows, axis=1).T.reindex(measurements_list)
+
+    def monthly_sums(self, measurement):
+        meta, cumulative = self.load(measurement)
+        if meta is None:
+            return pd.DataFrame()
+        month_starts = pd.date_range(meta['first_day'], meta['watermark'], freq='MS')
+        boundaries = [meta['first_day']] + [month for month in month_starts
+                                            if meta['first_day'] < month < meta['watermark']] \
+            + [meta['watermark']]
+        indexes = [(boundary - meta['first_day']).days for boundary in boundaries]
+        values = np.diff(np.asarray(cumulative[indexes]), axis=0)
+        month_labels = [boundary.strftime('%Y-%m') for boundary in boundaries[:-1]]
+        return pd.DataFrame(values, index=month_labels, columns=meta['columns'])
+
+    def append_days(self, measurement, first_day, end_day, daily_df):
+        # daily_df is indexed by day and must cover [first_day, end_day) once reindexed
+        meta, cumulative = self.load(measurement)
+        if meta is None:
+            meta = {'columns': [], 'first_day': first_day, 'watermark': first_day}
+            cumulative = np.zeros((1, 0))
+        if first_day != meta['watermark']:
+            raise ValueError('Rollup for {} must be extended from {}'.format(
+                measurement, meta['watermark'].date()))
+
+        days = pd.date_range(first_day, periods=(end_day - first_day).days, freq='D')
+        daily_df = daily_df.reindex(days).fillna(0.0)
+        columns = list(meta['columns']) + [col for col in daily_df.columns
+                                           if col not in meta['columns']]
+        daily_values = daily_df.reindex(columns=columns, fill_value=0.0).to_numpy(dtype=np.float64)
+
+        previous = np.zeros((cumulative.shape[0], len(columns)))
+        previous[:, :cumulative.shape[1]] = cumulative
+        appended = previous[-1] + np.cumsum(daily_values, axis=0)
+        cumulative = np.vstack([previous, appended])
+
+        meta_path, array_path = self._paths(measurement)
+        self._write_array(array_path, cumulative)
+        self._write_meta(meta_path, {'columns': columns,
+                                     'first_day': meta['first_day'].strftime('%Y-%m-%d'),
+                                     'watermark': end_day.strftime('%Y-%m-%d')})
+
+    def _write_array(self, path, array):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.npy')
+        with os.fdopen(file_descriptor, 'wb') as array_file:
+            np.save(array_file, array)
+        os.replace(temp_path, path)
+
+    def _write_meta(self, path, meta):
+        file_descriptor, temp_path = tempfile.mkstemp(dir=self.directory, suffix='.json')
+        with os.fdopen(file_descriptor, 'w') as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(temp_path, path)
+
+
+def query_daily_sums(influx_client, measurement, first_day, end_day):
+    where_parameters = {'t0': format_influx_date(first_day),
+                        't1': format_influx_date(end_day)}
+    query_influx = 'select sum(*) from {} where time>=$t0 and time<$t1 group by time(1d)'. \
+        format(utilities.quote_identifier(measurement))
+    query_result = influx_client.query(query_influx, bind_params=where_parameters)
+
+    if measurement not in query_result:
+        return pd.DataFrame()
+    daily_df = query_result[measurement]
+    daily_df.columns = [utilities.strip_sum_prefix(col_name) for col_name in daily_df.columns]
+    if daily_df.index.tz is not None:
+        daily_df.index = daily_df.index.tz_convert('UTC').tz_localize(None)
+    return daily_df
+
+
+def refresh_rollup(rollup_store, influx_client, measurements_list, start_date, end_date=None):
+    # Only whole days are stored, so the default end is today's midnight (UTC)
+    if end_date is None:
+        end_date = pd.Timestamp.utcnow()
+    end_day = floor_day(end_date)
+
+    for measurement in measurements_list:
+        first_day = rollup_store.watermark(measurement)
+        if first_day is None:
+            first_day = floor_day(start_date)
+
+        while first_day < end_day:
+            window_end = min(first_day + REFRESH_WINDOW_DAYS * ONE_DAY, end_day)
+            daily_df = query_daily_sums(influx_client, measurement, first_day, window_end)
+            rollup_store.append_days(measurement, first_day, window_end, daily_df)
+            first_day = window_end
+
+
+def generate_rollup_measurements(sensor_metadata, metric_list):
+    building_list = sensor_metadata['building'].unique()
+    return list(metric_list) + utilities.generate_building_list_sim(building_list)
+
+
+if __name__ == '__main__':
+    from influx_pool import ManagedInfluxClient
+
+    parser = argparse.ArgumentParser(description='Refresh the daily rollup store from InfluxDB')
+    parser.add_argument('directory')
+    parser.add_argument('--start', default='2015-01-01',
+                        help='first day to store when a measurement has no rollup yet')
+    parser.add_argument('--end', default=None, help='exclusive end day, defaults to today')
+    parser.add_argument('--host', default='206.12.88.106')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='sankey-generator')
+    arguments = parser.parse_args()
+
+    client = ManagedInfluxClient(host=arguments.host, port=arguments.port,
+                                 username='root', password='root',
+                                 database=arguments.database)
+    measurements = generate_rollup_measurements(
+        pd.read_csv('./metadata/sensorMetadata.csv'), ['Elec', 'Gas', 'HotWater'])
+    refresh_rollup(RollupStore(arguments.directory), client, measurements,
+                   arguments.start, arguments.end)
@@ -0,0 +1,208 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+
+# Layered layout of the Sankey diagrams, computed on the server so that plotly.js places the
+# nodes where they are given instead of running its iterative solver in the browser:
+# - every node is drawn in the column of its kind (metrics, periods, groups, buildings, ...)
+# - the nodes of a column are ordered to reduce the link crossings, by sweeps of the
+#   barycenter heuristic weighted by the link values, keeping the order with the least
+#   weighted crossings. The nodes of a block, a building and its simulation, stay together.
+# - nodes are stacked from the top of their column with heights proportional to their flow,
+#   nodes without flow take no room
+# With a LayoutCache, the first diagram of a node set orders it and the next ones (other dates,
+# a filter set back) reuse that order, so that the nodes keep their place between updates.
+N_SWEEPS = 4
+PADDING = 0.02
+
+
+def generate_layout_key(node_names, node_layers, node_blocks):
+    return (tuple(str(name) for name in node_names), np.asarray(node_layers).tobytes(),
+            np.asarray(node_blocks).tobytes())
+
+
+def generate_node_sizes(n_nodes, sources, targets, values):
+    # Flow through every node, the larger of what comes in and what goes out
+    inflow = np.bincount(targets, weights=values, minlength=n_nodes)
+    outflow = np.bincount(sources, weights=values, minlength=n_nodes)
+    return np.maximum(inflow, outflow)
+
+
+def generate_initial_ranks(node_layers):
+    # Nodes in their input order within each column
+    order = np.argsort(node_layers, kind='stable')
+    ranks = np.empty(len(node_layers), dtype=int)
+    layer_starts = np.searchsorted(node_layers[order], node_layers[order])
+    ranks[order] = np.arange(len(node_layers)) - layer_starts
+    return ranks
+
+
+def count_crossings(node_layers, ranks, sources, targets, values):
+    # Sum of the products of the values of every pair of crossing links, for the links between
+    # the same two columns: from the source x target matrix of the link values, every link
+    # crosses those leaving from below it and arriving above it
+    crossings = 0.0
+    layer_sizes = np.bincount(node_layers)
+    layer_pairs = node_layers[sources] * len(layer_sizes) + node_layers[targets]
+    for layer_pair in np.unique(layer_pairs):
+        in_pair = layer_pairs == layer_pair
+        source_layer, target_layer = divmod(layer_pair, len(layer_sizes))
+        link_matrix = np.zeros((layer_sizes[source_layer], layer_sizes[target_layer]))
+        np.add.at(link_matrix, (ranks[sources[in_pair]], ranks[targets[in_pair]]),
+                  values[in_pair])
+        below = np.cumsum(link_matrix[::-1], axis=0)[::-1][1:]
+        below_above = np.cumsum(below, axis=1)[:, :-1]
+        crossings += (link_matrix[:-1, 1:] * below_above).sum()
+    return crossings
+
+
+def order_nodes(node_layers, sources, targets, values, node_blocks=None, n_sweeps=N_SWEEPS):
+    # Rank of every node within its column
+    node_layers = np.asarray(node_layers, dtype=int)
+    sources = np.asarray(sources, dtype=int)
+    targets = np.asarray(targets, dtype=int)
+    values = np.abs(np.asarray(values, dtype=float))
+    if node_blocks is None:
+        node_blocks = np.arange(len(node_layers))
+    node_blocks = np.asarray(node_blocks, dtype=int)
+
+    ranks = generate_initial_ranks(node_layers)
+    if len(sources) == 0:
+        return ranks
+
+    # Both ends of every link, seen from either end
+    node_ends = np.concatenate((sources, targets))
+    other_ends = np.concatenate((targets, sources))
+    end_values = np.concatenate((values, values))
+    end_layers = node_layers[node_ends]
+    other_layers = node_layers[other_ends]
+    layer_sizes = np.bincount(node_layers)
+    n_blocks = node_blocks.max() + 1
+
+    def sweep_layer(layer, downward, ranks):
+        # Orders the blocks of a column by the mean position of their neighbours in the
+        # columns before it (or after it), weighted by the link values. Blocks without such
+        # neighbours keep their position.
+        positions = (ranks + 0.5) / layer_sizes[node_layers]
+        if downward:
+            linked = (end_layers == layer) & (other_layers < layer)
+        else:
+            linked = (end_layers == layer) & (other_layers > layer)
+        linked_blocks = node_blocks[node_ends[linked]]
+        block_weights = np.bincount(linked_blocks, weights=end_values[linked],
+                                    minlength=n_blocks)
+        block_sums = np.bincount(linked_blocks,
+                                 weights=end_values[linked] * positions[other_ends[linked]],
+                                 minlength=n_blocks)
+
+        layer_nodes = np.nonzero(node_layers == layer)[0]
+        blocks = node_blocks[layer_nodes]
+        first_ranks = np.full(n_blocks, np.inf)
+        np.minimum.at(first_ranks, blocks, ranks[layer_nodes])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            barycenters = np.where(block_weights > 0, block_sums / block_weights,
+                                   (first_ranks + 0.5) / layer_sizes[layer])
+
+        order = np.lexsort((ranks[layer_nodes], first_ranks[blocks], barycenters[blocks]))
+        ranks = ranks.copy()
+        ranks[layer_nodes[order]] = np.arange(len(layer_nodes))
+        return ranks
+
+    layers = np.unique(node_layers)
+    best_ranks = ranks
+    best_crossings = count_crossings(node_layers, ranks, sources, targets, values)
+    for _ in range(n_sweeps):
+        if best_crossings == 0:
+            break
+        for layer in layers[1:]:
+            ranks = sweep_layer(layer, True, ranks)
+        for layer in layers[-2::-1]:
+            ranks = sweep_layer(layer, False, ranks)
+        crossings = count_crossings(node_layers, ranks, sources, targets, values)
+        if crossings >= best_crossings:
+            break
+        best_ranks = ranks
+        best_crossings = crossings
+    return best_ranks
+
+
+def generate_layer_positions(node_layers, ranks, node_sizes, padding=PADDING):
+    # One column per layer, nodes stacked from the top in rank order with heights proportional
+    # to their size
+    node_layers = np.asarray(node_layers, dtype=int)
+    node_sizes = np.asarray(node_sizes, dtype=float)
+    layers = np.unique(node_layers)
+    x_values = np.empty(len(node_layers))
+    y_values = np.empty(len(node_layers))
+    for i, layer in enumerate(layers):
+        layer_nodes = np.nonzero(node_layers == layer)[0]
+        layer_nodes = layer_nodes[np.argsort(ranks[layer_nodes])]
+        sizes = node_sizes[layer_nodes]
+        gaps = np.where(sizes > 0, padding, 0.0)
+        total = sizes.sum()
+        available = max(1.0 - gaps.sum() + padding, 0.0)
+        heights = sizes / total * available if total > 0 else np.zeros(len(sizes))
+        tops = np.concatenate(([0.0], np.cumsum(heights + gaps)[:-1]))
+        x_values[layer_nodes] = i / max(len(layers) - 1, 1)
+        y_values[layer_nodes] = tops + heights / 2
+    return (list(np.clip(x_values, 0.001, 0.999)),
+            list(np.clip(y_values, 0.001, 0.999)))
+
+
+def generate_layout(node_names, node_layers, sources, targets, values, node_blocks=None,
+                    layout_cache=None):
+    # x and y of every node, the order of the node set taken from the cache when it has one.
+    # The node names only make the cache key, they are the labels of most diagrams.
+    node_layers = np.asarray(node_layers, dtype=int)
+    if node_blocks is None:
+        node_blocks = np.arange(len(node_layers))
+    sources = np.asarray(sources, dtype=int)
+    targets = np.asarray(targets, dtype=int)
+    values = np.abs(np.asarray(values, dtype=float))
+
+    ranks = None
+    if layout_cache is not None:
+        layout_key = generate_layout_key(node_names, node_layers, node_blocks)
+        ranks = layout_cache.get(layout_key)
+    if ranks is None:
+        ranks = order_nodes(node_layers, sources, targets, values, node_blocks)
+        if layout_cache is not None:
+            layout_cache.store(layout_key, ranks)
+
+    node_sizes = generate_node_sizes(len(node_layers), sources, targets, values)
+    return generate_layer_positions(node_layers, ranks, node_sizes)
+
+
+class LayoutCache:
+    # Node orders by node set, one per worker process
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, layout_key):
+        with self._lock:
+            ranks = self._entries.get(layout_key)
+            if ranks is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(layout_key)
+            self.hits += 1
+            return ranks
+
+    def store(self, layout_key, ranks):
+        with self._lock:
+            self._entries[layout_key] = ranks
+            self._entries.move_to_end(layout_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'entries': len(self._entries)}
@@ -0,0 +1,203 @@
+import base64
+import hashlib
+import json
+import threading
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+
+# Lean figure transport: the server sends typed arrays and palette indices, and
+# assets/sankey_transport.js assembles the Plotly Sankey trace in the browser.
+# Arrays travel as {'dtype': ..., 'data': <base64 of the little-endian bytes>}.
+DTYPES = {'int32': '<i4', 'float32': '<f4', 'uint8': 'u1', 'uint16': '<u2'}
+
+# Link deltas larger than this fraction of the encoded link arrays are sent as full links
+MAX_DELTA_RATIO = 0.75
+
+
+def encode_array(values, dtype):
+    array = np.ascontiguousarray(values, dtype=DTYPES[dtype])
+    return {'dtype': dtype, 'data': base64.b64encode(array.tobytes()).decode('ascii')}
+
+
+def encoded_size(arrays):
+    # Bytes of the encoded arrays among the given values, palettes and None are skipped
+    return sum(len(array['data']) for array in arrays
+               if isinstance(array, dict) and 'data' in array)
+
+
+def encode_palette(colors):
+    # Every distinct color string is sent once, the elements only carry its index
+    codes, palette = pd.factorize(pd.Series(list(colors), dtype=object))
+    dtype = 'uint8' if len(palette) <= 256 else 'uint16'
+    return list(palette), encode_array(codes, dtype)
+
+
+def generate_node_key(element_dict):
+    # The positions change with the data, they are sent with every payload instead
+    node_json = json.dumps([[str(label) for label in element_dict['labels']],
+                            list(element_dict['color_nodes'])])
+    return hashlib.sha1(node_json.encode('utf-8')).hexdigest()
+
+
+def generate_link_arrays(element_dict):
+    return {'source': np.asarray(element_dict['sources'], dtype=np.int32),
+            'target': np.asarray(element_dict['targets'], dtype=np.int32),
+            'value': np.asarray(element_dict['values'], dtype=np.float32),
+            'color': np.asarray(element_dict['color_links'], dtype=object)}
+
+
+def generate_links_key(node_key, links):
+    # Depends on the link order, as the deltas address links by position
+    digest = hashlib.sha1(node_key.encode('ascii'))
+    digest.update(links['source'].tobytes())
+    digest.update(links['target'].tobytes())
+    digest.update(links['value'].tobytes())
+    digest.update('|'.join(links['color']).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def encode_links(links):
+    link_palette, link_colors = encode_palette(links['color'])
+    return {'source': encode_array(links['source'], 'int32'),
+            'target': encode_array(links['target'], 'int32'),
+            'value': encode_array(links['value'], 'float32'),
+            'palette': link_palette,
+            'color': link_colors}
+
+
+def generate_sankey_payload(element_dict):
+    # Returns the full payload sent to the browser and the link state it was built from
+    node_palette, node_colors = encode_palette(element_dict['color_nodes'])
+    labels = [str(label) for label in element_dict['labels']]
+    nodes = {'labels': labels,
+             'palette': node_palette,
+             'color': node_colors}
+    positions = None
+    if len(element_dict['x_values']) > 0:
+        positions = {'x': encode_array(element_dict['x_values'], 'float32'),
+                     'y': encode_array(element_dict['y_values'], 'float32')}
+
+    node_key = generate_node_key(element_dict)
+    links = generate_link_arrays(element_dict)
+    payload = {'node_key': node_key,
+               'links_key': generate_links_key(node_key, links),
+               'nodes': nodes,
+               'positions': positions,
+               'links': encode_links(links),
+               'delta': None,
+               'frames': None}
+    # Time-resolved views send the link values of every frame as one frame x link array
+    if 'frame_values' in element_dict:
+        payload['frames'] = {'labels': list(element_dict['frame_labels']),
+                             'value': encode_array(np.ravel(element_dict['frame_values']),
+                                                   'float32')}
+    return {'payload': payload, 'labels': labels, 'links': links}
+
+
+def generate_occurrences(frame, columns):
+    # Rank of every row among the rows with the same values, to pair up duplicates
+    frame['occurrence'] = frame.groupby(columns, sort=False).cumcount()
+    return frame
+
+
+def generate_node_map(base_labels, labels):
+    # New index of every base node, -1 for the nodes that are gone
+    base_nodes = generate_occurrences(pd.DataFrame({'label': base_labels}), ['label'])
+    nodes = generate_occurrences(pd.DataFrame({'label': labels,
+                                               'position': np.arange(len(labels))}), ['label'])
+    node_map = base_nodes.merge(nodes, on=['label', 'occurrence'], how='left')['position']
+    return node_map.fillna(-1).to_numpy(dtype=np.int32)
+
+
+def generate_links_delta(base_links, links, node_map=None):
+    # Changes turning base_links into links: base links renumbered with node_map, values
+    # updated in place, links removed and new links appended. Returns the delta, the links in
+    # the order the browser ends up with (kept base links first, then the added ones).
+    base_links = dict(base_links)
+    if node_map is not None:
+        base_links['source'] = node_map[base_links['source']]
+        base_links['target'] = node_map[base_links['target']]
+
+    link_columns = ['source', 'target', 'color']
+    base_identity = generate_occurrences(
+        pd.DataFrame({name: base_links[name] for name in link_columns}), link_columns)
+    identity = generate_occurrences(
+        pd.DataFrame({name: links[name] for name in link_columns}), link_columns)
+    matched = base_identity.reset_index().merge(identity.reset_index(),
+                                                on=link_columns + ['occurrence'], how='outer',
+                                                suffixes=('_base', ''), indicator=True)
+
+    kept = matched[matched['_merge'] == 'both']
+    base_index = kept['index_base'].to_numpy(dtype=int)
+    new_values = links['value'][kept['index'].to_numpy(dtype=int)]
+    changed = base_links['value'][base_index] != new_values
+    removed = np.sort(matched.loc[matched['_merge'] == 'left_only',
+                                  'index_base'].to_numpy(dtype=int))
+    added = np.sort(matched.loc[matched['_merge'] == 'right_only', 'index'].to_numpy(dtype=int))
+
+    updated_values = base_links['value'].copy()
+    updated_values[base_index[changed]] = new_values[changed]
+    keep = np.ones(len(base_links['value']), dtype=bool)
+    keep[removed] = False
+    added_links = {name: array[added] for name, array in links.items()}
+    delta_links = {name: np.concatenate((base_links[name][keep], added_links[name]))
+                   for name in link_columns}
+    delta_links['value'] = np.concatenate((updated_values[keep], added_links['value']))
+
+    delta = {'node_map': None if node_map is None else encode_array(node_map, 'int32'),
+             'update_index': encode_array(base_index[changed], 'int32'),
+             'update_value': encode_array(new_values[changed], 'float32'),
+             'remove': encode_array(removed, 'int32'),
+             'add': encode_links(added_links)}
+    return delta, delta_links
+
+
+class LinkHistory:
+    # Link states recently sent to browsers, by links key, to compute the next deltas from
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, links_key):
+        with self._lock:
+            entry = self._entries.get(links_key)
+            if entry is not None:
+                self._entries.move_to_end(links_key)
+            return entry
+
+    def store(self, links_key, labels, links):
+        with self._lock:
+            self._entries[links_key] = (labels, links)
+            self._entries.move_to_end(links_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+
+def generate_sankey_update(sankey_output, client_state, link_history):
+    # client_state is what the browser drew last: {'node_key': ..., 'links_key': ...}.
+    # Unchanged nodes are left out but for their positions, and when the links sent last to
+    # this browser are known only the link changes are sent, unless they are about as large as
+    # the links themselves.
+    payload = sankey_output['payload']
+    same_nodes = bool(client_state) and client_state.get('node_key') == payload['node_key']
+    base = link_history.get(client_state.get('links_key')) if client_state else None
+
+    if base is not None and payload['frames'] is None:
+        base_labels, base_links = base
+        node_map = None if same_nodes else generate_node_map(base_labels,
+                                                             sankey_output['labels'])
+        delta, delta_links = generate_links_delta(base_links, sankey_output['links'], node_map)
+        delta_size = encoded_size(list(delta.values()) + list(delta['add'].values()))
+        if delta_size <= MAX_DELTA_RATIO * encoded_size(payload['links'].values()):
+            delta['base'] = client_state['links_key']
+            links_key = generate_links_key(payload['node_key'], delta_links)
+            link_history.store(links_key, sankey_output['labels'], delta_links)
+            return dict(payload, nodes=None if same_nodes else payload['nodes'], links=None,
+                        links_key=links_key, delta=delta)
+
+    link_history.store(payload['links_key'], sankey_output['labels'], sankey_output['links'])
+    return dict(payload, nodes=None if same_nodes else payload['nodes'])
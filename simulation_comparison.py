@@ -0,0 +1,157 @@
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+import utilities
+
+
+# Measured against simulated energy use of every building and category, for every period:
+#   real, simulation   period x building x category sums of the sensors
+#   error              real - simulation, positive where the simulation is short
+# The calibration metrics follow ASHRAE Guideline 14 over the periods, n of them:
+#   NMBE      = sum(error) / ((n - p) x mean(real)) x 100
+#   CV(RMSE)  = sqrt(sum(error^2) / (n - p)) / mean(real) x 100
+# with p the number of parameters of the model, 0 by default. They are NaN when the mean of
+# the measured values is zero or n <= p.
+TOTAL_LABEL = 'Total'
+
+
+def generate_simulation_comparison(query_result_dates, sensor_metadata, category_type):
+    building_list = sensor_metadata.building.unique()
+    category_list = sensor_metadata[category_type].unique()
+    date_ranges = list(query_result_dates.keys())
+    building_list_sim = utilities.generate_building_list_sim(building_list)
+    # Real buildings first, then their simulations, so that the row of a simulation is the
+    # row of its building plus the number of buildings
+    row_list = building_list_sim[0::2] + building_list_sim[1::2]
+
+    shape = (len(date_ranges), len(row_list), len(category_list))
+    sums = np.zeros(shape)
+    for i, date_range in enumerate(date_ranges):
+        query_result = query_result_dates[date_range]
+        sensor_category = utilities.generate_indicator_matrix(sensor_metadata.sensor_short_id,
+                                                              sensor_metadata[category_type],
+                                                              query_result.columns, category_list)
+        rows, categories, values = utilities.generate_sparse_group_sums(query_result, row_list,
+                                                                        sensor_category)
+        sums[i, rows, categories] = values
+
+    real = sums[:, :len(building_list)]
+    simulation = sums[:, len(building_list):]
+    return {'date_ranges': date_ranges,
+            'buildings': building_list,
+            'categories': category_list,
+            'real': real,
+            'simulation': simulation,
+            'error': real - simulation}
+
+
+def generate_error_metrics(real, error, n_parameters=0):
+    # NMBE and CV(RMSE) in percent over the first axis
+    n_degrees = real.shape[0] - n_parameters
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean_real = real.mean(axis=0)
+        nmbe = error.sum(axis=0) / (n_degrees * mean_real) * 100
+        cv_rmse = np.sqrt((error ** 2).sum(axis=0) / n_degrees) / mean_real * 100
+    undefined = (mean_real == 0) | (n_degrees <= 0)
+    nmbe[undefined] = np.nan
+    cv_rmse[undefined] = np.nan
+    return nmbe, cv_rmse
+
+
+def generate_comparison_metrics(comparison, n_parameters=0):
+    # One row per building and category with data, plus the total of every building
+    real = np.concatenate((comparison['real'],
+                           comparison['real'].sum(axis=2, keepdims=True)), axis=2)
+    simulation = np.concatenate((comparison['simulation'],
+                                 comparison['simulation'].sum(axis=2, keepdims=True)), axis=2)
+    error = real - simulation
+    nmbe, cv_rmse = generate_error_metrics(real, error, n_parameters)
+
+    categories = np.concatenate((comparison['categories'], [TOTAL_LABEL]), axis=None)
+    metrics_df = pd.DataFrame({
+        'building': np.repeat(comparison['buildings'], len(categories)),
+        'category': np.tile(categories, len(comparison['buildings'])),
+        'periods': real.shape[0],
+        'real': real.sum(axis=0).ravel(),
+        'simulation': simulation.sum(axis=0).ravel(),
+        'error': error.sum(axis=0).ravel(),
+        'absolute_error': np.abs(error).sum(axis=0).ravel(),
+        'nmbe': nmbe.ravel(),
+        'cv_rmse': cv_rmse.ravel()})
+    has_data = (np.abs(real) + np.abs(simulation)).sum(axis=0).ravel() > 0
+    return metrics_df[has_data].reset_index(drop=True)
+
+
+def generate_comparison_table(comparison):
+    # One row per period, building and category with a measured or a simulated value
+    shape = comparison['real'].shape
+    table_df = pd.DataFrame({
+        'date_range': np.repeat(comparison['date_ranges'], shape[1] * shape[2]),
+        'building': np.tile(np.repeat(comparison['buildings'], shape[2]), shape[0]),
+        'category': np.tile(comparison['categories'], shape[0] * shape[1]),
+        'real': comparison['real'].ravel(),
+        'simulation': comparison['simulation'].ravel(),
+        'error': comparison['error'].ravel(),
+        'absolute_error': np.abs(comparison['error']).ravel()})
+    has_data = (table_df['real'] != 0) | (table_df['simulation'] != 0)
+    return table_df[has_data].reset_index(drop=True)
+
+
+if __name__ == '__main__':
+    import batch_export
+    import generate_graph
+    import metadata_cache
+    import metadata_index
+    import rollup
+
+    parser = argparse.ArgumentParser(description='Compare the simulated energy use of the '
+                                                 'buildings to the measured one')
+    parser.add_argument('output_dir', help='errors.csv and metrics.csv are written there')
+    parser.add_argument('--months', nargs=2, metavar=('START', 'END'), required=True,
+                        help='compare every month from START to END (YYYY-MM)')
+    parser.add_argument('--buildings', nargs='+', help='defaults to every building')
+    parser.add_argument('--category-type', default='category_end_use')
+    parser.add_argument('--parameters', type=int, default=0,
+                        help='parameters of the model, p in the metrics')
+    parser.add_argument('--parquet-dir', help='read the offline Arrow export instead of InfluxDB')
+    parser.add_argument('--rollup-dir', help='daily rollup store kept by rollup.py')
+    parser.add_argument('--metadata-cache-dir', help='compiled metadata, see metadata_cache.py')
+    parser.add_argument('--host', default='206.12.88.106')
+    parser.add_argument('--port', type=int, default=8086)
+    parser.add_argument('--database', default='sankey-generator')
+    arguments = parser.parse_args()
+
+    index = metadata_index.MetadataIndex(
+        metadata_cache.read_metadata('./metadata/sensorMetadata.csv',
+                                     arguments.metadata_cache_dir),
+        metadata_cache.read_metadata('./metadata/BuildingMetadataAll.csv',
+                                     arguments.metadata_cache_dir),
+        [])
+    if arguments.category_type not in index.category_columns:
+        parser.error('unknown category type {}'.format(arguments.category_type))
+    building_names = arguments.buildings or list(index.building_sensors)
+    unknown_buildings = set(building_names) - set(index.building_sensors)
+    if unknown_buildings:
+        parser.error('no sensors for {}'.format(', '.join(sorted(unknown_buildings))))
+
+    if arguments.parquet_dir:
+        import parquet_source
+        client = parquet_source.ParquetSource(arguments.parquet_dir)
+    else:
+        from influx_pool import ManagedInfluxClient
+        client = ManagedInfluxClient(host=arguments.host, port=arguments.port,
+                                     username='root', password='root',
+                                     database=arguments.database)
+    store = rollup.RollupStore(arguments.rollup_dir) if arguments.rollup_dir else None
+
+    result = generate_graph.query_simulation_comparison(
+        client, index, arguments.category_type,
+        batch_export.generate_month_periods(*arguments.months), building_names, store)
+    os.makedirs(arguments.output_dir, exist_ok=True)
+    generate_comparison_table(result).to_csv(os.path.join(arguments.output_dir, 'errors.csv'),
+                                             index=False)
+    generate_comparison_metrics(result, arguments.parameters).to_csv(
+        os.path.join(arguments.output_dir, 'metrics.csv'), index=False)
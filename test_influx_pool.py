@@ -0,0 +1,179 @@
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+from influxdb.exceptions import InfluxDBServerError
+
+import generate_graph
+import influx_pool
+import influx_stream
+
+
+# ManagedInfluxClient against a stub InfluxDB on an ephemeral local port:
+#   python -m unittest test_influx_pool
+# Every test sets the answers of the stub with a function of the request number.
+def generate_result(name, columns, values):
+    return {'results': [{'statement_id': 0,
+                         'series': [{'name': name, 'columns': columns, 'values': values}]}]}
+
+
+class StubInfluxHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.n_requests += 1
+            request_number = server.n_requests
+            server.running += 1
+            server.max_running = max(server.max_running, server.running)
+        try:
+            status, body = server.answer(request_number)
+            if isinstance(body, list):
+                self.send_chunked(status, body)
+            else:
+                self.send_body(status, json.dumps(body).encode('utf-8'))
+        finally:
+            with server.lock:
+                server.running -= 1
+
+    def send_body(self, status, data):
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_chunked(self, status, documents):
+        # One JSON document per line, each line in its own HTTP chunk as influx does
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+        for document in documents:
+            line = json.dumps(document).encode('utf-8') + b'\n'
+            self.wfile.write('{:x}\r\n'.format(len(line)).encode('ascii') + line + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, *args):
+        pass
+
+
+class ManagedInfluxClientTest(unittest.TestCase):
+    def setUp(self):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), StubInfluxHandler)
+        self.server.daemon_threads = True
+        self.server.lock = threading.Lock()
+        self.server.n_requests = 0
+        self.server.running = 0
+        self.server.max_running = 0
+        self.server.answer = lambda request_number: (200, {'results': [{'statement_id': 0}]})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = self.create_client(self.server.server_address[1])
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def create_client(self, port, **kwargs):
+        kwargs = dict({'timeout': 5, 'retries': 2, 'backoff': 0.0, 'max_in_flight': 2},
+                      **kwargs)
+        return influx_pool.ManagedInfluxClient(host='127.0.0.1', port=port, database='test',
+                                               **kwargs)
+
+    def assert_slots_released(self, client):
+        acquired = 0
+        while client._in_flight.acquire(blocking=False):
+            acquired += 1
+        for _ in range(acquired):
+            client._in_flight.release()
+        self.assertEqual(acquired, client.max_in_flight)
+
+    def test_server_errors_are_retried(self):
+        result = generate_result('Elec', ['time', 'sum_a'], [['2020-10-01T00:00:00Z', 5.0]])
+        self.server.answer = lambda request_number: ((500, {'error': 'busy'})
+                                                     if request_number <= 2 else (200, result))
+
+        with self.assertLogs(influx_pool.logger, 'WARNING'):
+            query_result = self.client.query('select sum(*) from "Elec"')
+
+        self.assertEqual(self.server.n_requests, 3)
+        self.assertEqual(query_result['Elec']['sum_a'].tolist(), [5.0])
+        self.assert_slots_released(self.client)
+
+    def test_retries_give_up(self):
+        self.server.answer = lambda request_number: (503, {'error': 'unavailable'})
+
+        with self.assertLogs(influx_pool.logger, 'WARNING'), \
+                self.assertRaises(InfluxDBServerError):
+            self.client.query('select sum(*) from "Elec"')
+
+        self.assertEqual(self.server.n_requests, self.client.max_retries + 1)
+        self.assert_slots_released(self.client)
+
+    def test_connection_errors_are_retried(self):
+        # Nothing listens on the port of a closed server
+        closed_server = ThreadingHTTPServer(('127.0.0.1', 0), StubInfluxHandler)
+        port = closed_server.server_address[1]
+        closed_server.server_close()
+        client = self.create_client(port, retries=1)
+
+        with self.assertLogs(influx_pool.logger, 'WARNING'), \
+                self.assertRaises(requests.exceptions.ConnectionError):
+            client.query('select sum(*) from "Elec"')
+
+        self.assert_slots_released(client)
+
+    def test_chunked_answer_is_streamed(self):
+        # The chunks of a series are summed into the row of its measurement
+        documents = [generate_result('Elec', ['time', 'sum_a', 'sum_b'],
+                                     [['2020-10-01T00:00:00Z', 1.0, None]]),
+                     generate_result('Elec', ['time', 'sum_a', 'sum_b'],
+                                     [['2020-10-02T00:00:00Z', 2.0, 4.0]]),
+                     generate_result('Gas', ['time', 'sum_a'],
+                                     [['2020-10-01T00:00:00Z', 3.0]])]
+        self.server.answer = lambda request_number: (200, documents)
+
+        sums = generate_graph.query_field_sums(self.client, '2020-10-01T00:00:00Z',
+                                               '2020-10-03T00:00:00Z', ['Elec', 'Gas', 'Water'])
+
+        self.assertEqual(sums.loc['Elec', 'a'], 3.0)
+        self.assertEqual(sums.loc['Elec', 'b'], 4.0)
+        self.assertEqual(sums.loc['Gas', 'a'], 3.0)
+        self.assertTrue(sums.loc['Water'].isna().all())
+        self.assert_slots_released(self.client)
+
+    def test_stream_error_releases_the_slot(self):
+        documents = [generate_result('Elec', ['time', 'sum_a'], [['2020-10-01T00:00:00Z', 1.0]]),
+                     {'error': 'partial failure'}]
+        self.server.answer = lambda request_number: (200, documents)
+
+        with self.assertRaises(influx_stream.InfluxStreamError):
+            generate_graph.query_field_sums(self.client, '2020-10-01T00:00:00Z',
+                                            '2020-10-03T00:00:00Z', ['Elec'])
+
+        self.assert_slots_released(self.client)
+
+    def test_in_flight_queries_are_capped(self):
+        def answer(request_number):
+            time.sleep(0.1)
+            return 200, {'results': [{'statement_id': 0}]}
+        self.server.answer = answer
+
+        threads = [threading.Thread(target=self.client.query,
+                                    args=('select sum(*) from "Elec"',)) for _ in range(6)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(self.server.n_requests, 6)
+        self.assertLessEqual(self.server.max_running, self.client.max_in_flight)
+        self.assert_slots_released(self.client)
+
+
+if __name__ == '__main__':
+    unittest.main()
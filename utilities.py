@@ -1,3 +1,7 @@
+from datetime import datetime as dt
+from datetime import timedelta
+
+import numpy as np
 import pandas as pd
 
 
@@ -10,11 +14,28 @@ def generate_string_from_array(array):
     return array_string[:-2]
 
 
+def strip_sum_prefix(col_name):
+    # select sum(*) names every field 'sum_<field>'
+    if col_name.startswith('sum_'):
+        return col_name[len('sum_'):]
+    return col_name
+
+
+def quote_identifier(identifier):
+    # InfluxQL double-quoted identifier, safe for names with spaces, dashes or quotes
+    return '"' + identifier.replace('\\', '\\\\').replace('"', '\\"') + '"'
+
+
+def generate_projected_sums(columns):
+    # Aliased so the result columns keep the field names instead of 'sum', 'sum_1', ...
+    return generate_string_from_array(['sum({0}) as {0}'.format(quote_identifier(col_name))
+                                       for col_name in columns])
+
+
 def generate_top_n_list(query_result_dates, element_list, n):
-    temp_df = pd.DataFrame()
-    for key in query_result_dates.keys():
-        temp_df = temp_df.append(query_result_dates[key])
-    n_list = temp_df.sum(axis=0).filter(element_list).sort_values(ascending=False).index[:n]
+    temp_df = pd.concat([query_result.sum(axis=0) for query_result
+                         in query_result_dates.values()], axis=1)
+    n_list = temp_df.sum(axis=1).filter(element_list).sort_values(ascending=False).index[:n]
 
     return list(n_list)
 
@@ -35,10 +56,8 @@ def generate_option_array_from_list(list_of_options):
 
 
 def generate_df_from_query_result(query_result):
-    df = pd.DataFrame()
-    metric_list = query_result.keys()
-    for metric in metric_list:
-        df = df.append(query_result[metric])
+    metric_list = list(query_result.keys())
+    df = pd.concat([query_result[metric] for metric in metric_list])
     df.index = metric_list
     return df
 
@@ -53,6 +72,19 @@ def generate_category_options(columns):
     return options
 
 
+def generate_comparison_dates(start_date, end_date):
+    # Comparison period proposed when it is enabled: the selected period 30 days earlier
+    start_date_compare = dt.strftime(dt.strptime(start_date, "%Y-%m-%d") -
+                                     timedelta(days=30), "%Y-%m-%d")
+    end_date_compare = dt.strftime(dt.strptime(end_date, "%Y-%m-%d") -
+                                   timedelta(days=30), "%Y-%m-%d")
+    return start_date_compare, end_date_compare
+
+
+def generate_other_label(group):
+    return 'Other ({})'.format(group)
+
+
 def generate_building_list_sim(building_list):
     building_list_sim = []
     for building in building_list:
@@ -67,3 +99,51 @@ def generate_simulation_labels(category_list):
         labels_list.append(element)
         labels_list.append(element+'_SIMULATION')
     return labels_list
+
+
+def generate_label_index(labels):
+    # First position of every label, as np.where(labels == label)[0][0] would return it
+    label_index = {}
+    for i, label in enumerate(labels):
+        label_index.setdefault(label, i)
+    return label_index
+
+
+def generate_indicator_matrix(keys, groups, key_list, group_list):
+    # Boolean matrix with one row per key of key_list and one column per group of group_list,
+    # True where a metadata row maps the key to the group. Keys and groups that are NaN or
+    # not in the lists get the code -1, which points at the extra all-False row and column.
+    key_codes, key_uniques = pd.factorize(pd.Index(key_list))
+    group_codes, group_uniques = pd.factorize(pd.Index(group_list))
+    key_position = key_uniques.get_indexer(keys)
+    group_position = group_uniques.get_indexer(groups)
+    found = (key_position >= 0) & (group_position >= 0) & pd.notna(groups).to_numpy()
+
+    indicator = np.zeros((len(key_uniques) + 1, len(group_uniques) + 1), dtype=bool)
+    indicator[key_position[found], group_position[found]] = True
+    return indicator[key_codes][:, group_codes]
+
+
+def generate_sparse_group_sums(query_result, row_list, indicator):
+    # Non-zero sums of the query result columns per group, for the rows of row_list, as
+    # (row, group, value) arrays sorted by row and group. Only the non-empty cells of the query
+    # result are read, missing rows and values count as zero.
+    values = query_result.reindex(index=row_list).to_numpy(dtype=float)
+    cell_rows, cell_cols = np.nonzero((values != 0) & ~np.isnan(values))
+    cell_values = values[cell_rows, cell_cols]
+
+    # Every cell is repeated once per group of its column
+    pair_cols, pair_groups = np.nonzero(indicator)
+    group_counts = np.bincount(pair_cols, minlength=indicator.shape[0])
+    group_starts = np.cumsum(group_counts) - group_counts
+    cell_counts = group_counts[cell_cols]
+    cell_index = np.repeat(np.arange(len(cell_cols)), cell_counts)
+    pair_index = np.arange(cell_counts.sum()) + np.repeat(
+        group_starts[cell_cols] - (np.cumsum(cell_counts) - cell_counts), cell_counts)
+
+    n_groups = indicator.shape[1]
+    keys, key_index = np.unique(cell_rows[cell_index] * n_groups + pair_groups[pair_index],
+                                return_inverse=True)
+    sums = np.bincount(key_index, weights=cell_values[cell_index], minlength=len(keys))
+    non_zero = sums != 0
+    return keys[non_zero] // n_groups, keys[non_zero] % n_groups, sums[non_zero]